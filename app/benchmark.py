@@ -0,0 +1,235 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sqlite3 as sqlite3_
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.sqlite3_file import SQLiteFile  # noqa: E402
+
+# name: (page_size, columns, row generator)
+DATASETS = {
+    "ints": (4096, "a, b, c", lambda r, i: (i, r.randint(-2 ** 15, 2 ** 15), r.randint(-2 ** 47, 2 ** 47))),
+    "mixed": (4096, "a, b, c, d, e", lambda r, i: (
+        r.randint(0, 1000), r.random() * 1e6, "row %s %s" % (i, "x" * r.randint(0, 40)),
+        r.randbytes(r.randint(0, 64)), None if i % 3 else i)),
+    "overflow": (1024, "a, b, c", lambda r, i: (
+        i, r.randbytes(r.choice([10, 100, 2000, 20000])), "t" * r.choice([5, 1500, 8000]))),
+    "deep": (512, "a, b", lambda r, i: (i, "k%040d" % r.randint(0, 10 ** 12))),
+}
+
+
+def generate(path, dataset, rows, seed=0):
+    page_size, columns, row = DATASETS[dataset]
+    r = random.Random(seed)
+    conn = sqlite3_.connect(path)
+    conn.execute("PRAGMA page_size=%d" % page_size)
+    conn.execute("CREATE TABLE t (%s)" % columns)
+    conn.executemany("INSERT INTO t VALUES (%s)" % ", ".join("?" * len(columns.split(","))),
+                     (row(r, i) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def database(directory, dataset, rows, seed=0):
+    path = os.path.join(directory, "%s-%d-%d.db" % (dataset, rows, seed))
+    if not os.path.exists(path):
+        generate(path + ".tmp", dataset, rows, seed)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def collect(path):
+    # raw inputs for the decoder benchmarks: the header, every page of t and every cell of its leaves
+    with open(path, "rb") as f:
+        file = SQLiteFile(f)
+        header = file.source.read(0, 100)
+        pages = [file.load_btree_page(i, cache=False) for i in pages_of(file, "t")]
+        cells = [(page, offset) for page in pages if page.header['page_type'] == 13
+                 for offset in page.header['cell_offset_array']]
+        payloads = [page.raw_payload(page.cell(i), file.source)
+                    for page in pages if page.header['page_type'] == 13 for i in range(page.cell_number)]
+        payloads = [bytes(payload) for payload in payloads]
+        lookups = [page.cell(i)['rowid'] for page in pages if page.header['page_type'] == 13
+                   for i in range(page.cell_number)]
+        depth = 1
+        page = file.load_btree_page(file.root_page("t"))
+        while page.header['page_type'] == 5:
+            page = file.load_btree_page(page.child(0))
+            depth += 1
+    return header, [page.page_bin for page in pages], cells, payloads, lookups, depth
+
+
+def pages_of(file, table):
+    stack = [file.root_page(table)]
+    result = []
+    while stack:
+        index = stack.pop()
+        result.append(index)
+        page = file.load_btree_page(index, cache=False)
+        if page.header['page_type'] == 5:
+            for i in range(page.cell_number, -1, -1):
+                stack.append(page.child(i))
+    return result
+
+
+def bench_header(path, inputs, repeat):
+    header = inputs[0]
+    for _ in range(repeat):
+        SQLiteFile.readbin("header_schema", header)
+    return {"rows": repeat, "bytes": repeat * len(header)}
+
+
+def bench_page_header(path, inputs, repeat):
+    pages = inputs[1]
+    for page_bin in pages:
+        SQLiteFile.readbin("page_header_schema", page_bin)
+    return {"pages": len(pages), "bytes": sum(len(page_bin) for page_bin in pages)}
+
+
+def bench_cell_header(path, inputs, repeat):
+    cells = inputs[2]
+    for page, offset in cells:
+        SQLiteFile.readbin("cell_header_schema", page.page_bin, cache=page.cell_cache.copy(), offset=offset)
+    return {"rows": len(cells), "pages": len({id(page) for page, _ in cells})}
+
+
+def bench_record(path, inputs, repeat):
+    payloads = inputs[3]
+    for payload in payloads:
+        SQLiteFile.readbin("record_format_schema", payload)
+    return {"rows": len(payloads), "bytes": sum(len(payload) for payload in payloads)}
+
+
+def bench_scan(path, inputs, repeat, **kwargs):
+    with open(path, "rb") as f:
+        file = SQLiteFile(f, **kwargs)
+        rows = sum(1 for _ in file.iter_rows("t"))
+        return {"rows": rows, "pages": len(inputs[1]), "bytes": os.path.getsize(path)}
+
+
+def bench_scan_projection(path, inputs, repeat):
+    with open(path, "rb") as f:
+        file = SQLiteFile(f)
+        rows = sum(1 for _ in file.iter_rows("t", columns=[0]))
+        return {"rows": rows, "pages": len(inputs[1]), "bytes": os.path.getsize(path)}
+
+
+def bench_lookup(path, inputs, repeat):
+    rowids = random.Random(1).choices(inputs[4], k=repeat)
+    with open(path, "rb") as f:
+        file = SQLiteFile(f)
+        for rowid in rowids:
+            file.get_row("t", rowid)
+    return {"rows": len(rowids)}
+
+
+BENCHMARKS = {
+    "header": bench_header,
+    "page_header": bench_page_header,
+    "cell_header": bench_cell_header,
+    "record": bench_record,
+    "scan": bench_scan,
+    "scan_mmap": lambda path, inputs, repeat: bench_scan(path, inputs, repeat, mmap=True),
+    "scan_projection": bench_scan_projection,
+    "lookup": bench_lookup,
+}
+
+
+def measure(func, path, inputs, repeat, *, rounds=3, memory=True):
+    best = None
+    for _ in range(rounds):
+        gc.collect()
+        start = time.perf_counter()
+        counts = func(path, inputs, repeat)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    result = {"seconds": best}
+    result.update(counts)
+    if "rows" in counts:
+        result["rows_per_s"] = counts["rows"] / best
+    if "pages" in counts:
+        result["pages_per_s"] = counts["pages"] / best
+    if "bytes" in counts:
+        result["mb_per_s"] = counts["bytes"] / best / 1e6
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        func(path, inputs, repeat)
+        result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run(args):
+    directory = args.dir or os.path.join(tempfile.gettempdir(), "binary_reader_benchmark")
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    for dataset in args.datasets:
+        for rows in args.rows:
+            path = database(directory, dataset, rows, args.seed)
+            inputs = collect(path)
+            for name in args.benchmarks:
+                result = measure(BENCHMARKS[name], path, inputs, args.repeat, rounds=args.rounds,
+                                 memory=not args.no_memory)
+                result.update({"dataset": dataset, "rows_in_table": rows, "benchmark": name,
+                               "file_size": os.path.getsize(path), "depth": inputs[5]})
+                results.append(result)
+                print("%-9s %8d %-16s %8.3fs %s" % (dataset, rows, name, result["seconds"], " ".join(
+                    "%s=%.0f" % (k, result[k]) for k in ("rows_per_s", "pages_per_s", "mb_per_s", "peak_memory")
+                    if result.get(k) is not None)), file=sys.stderr)
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sqlite": sqlite3_.sqlite_version,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def compare(old, new):
+    # seconds ratio new/old for every benchmark found in both runs, > 1 is a slowdown
+    key = lambda r: (r["dataset"], r["rows_in_table"], r["benchmark"])
+    before = {key(r): r for r in old["results"]}
+    for r in new["results"]:
+        if key(r) in before:
+            print("%-9s %8d %-16s %6.2fx" % (key(r) + (r["seconds"] / before[key(r)]["seconds"],)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the sqlite3 reader on synthetic databases")
+    parser.add_argument("--datasets", nargs="+", default=list(DATASETS), choices=list(DATASETS))
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--rows", nargs="+", type=int, default=[10000])
+    parser.add_argument("--repeat", type=int, default=1000, help="header decodes and point lookups per round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", help="where generated databases are kept")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc peak memory pass")
+    parser.add_argument("--output", "-o", help="write results as json")
+    parser.add_argument("--compare", help="previous json results to compare against")
+    args = parser.parse_args(argv)
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
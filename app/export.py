@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.sqlite3_file import SQLiteFile  # noqa: E402
+
+FORMATS = ("csv", "jsonl", "binary")
+CHUNK_SIZE = 1 << 22
+# chunks waiting for the writer thread, bounds the memory of a pipelined export
+PIPELINE_DEPTH = 4
+# binary rows: rowid, size of the record, then the record as stored by sqlite3, see sqlite3_schema.read_record
+BINARY_ROW = struct.Struct("!qI")
+
+
+def iter_rows(file, table, *, columns=None, workers=None):
+    # in rowid order, straight from the tree: pages are not cached, so memory does not grow with the table
+    if workers is not None and workers > 1:
+        return file.parallel_scan(table, workers, columns=columns, ordered=True)
+    return file.iter_rows(table, columns=columns, cache=False)
+
+
+def plain(value):
+    return value.hex() if isinstance(value, (bytes, bytearray, memoryview)) else value
+
+
+def csv_field(value):
+    # minimal quoting as csv.writer does (plus a lone \r), csv.writer goes through every field a character
+    # at a time and takes longer than decoding the row once the values are a few kilobytes
+    if isinstance(value, str):
+        if '"' in value or "," in value or "\n" in value or "\r" in value:
+            return '"' + value.replace('"', '""') + '"'
+        return value
+    if value is None:
+        return ""
+    return plain(value) if isinstance(value, (bytes, bytearray, memoryview)) else str(value)
+
+
+def csv_chunks(rows, *, rowid=False, chunk_size=CHUNK_SIZE):
+    lines, size = [], 0
+    for id_, values in rows:
+        line = ",".join(map(csv_field, values))
+        if rowid:
+            line = "%d,%s" % (id_, line) if values else str(id_)
+        elif len(values) == 1 and not line:
+            line = '""'
+        lines.append(line)
+        size += len(line) + 1
+        if size >= chunk_size:
+            lines.append("")
+            yield "\n".join(lines).encode("utf-8")
+            lines, size = [], 0
+    if lines:
+        lines.append("")
+        yield "\n".join(lines).encode("utf-8")
+
+
+def jsonl_chunks(rows, *, rowid=False, chunk_size=CHUNK_SIZE):
+    encode = json.JSONEncoder(separators=(",", ":"), default=plain).encode
+    lines, size = [], 0
+    for id_, values in rows:
+        line = encode([id_] + values if rowid else values)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= chunk_size:
+            lines.append("")
+            yield "\n".join(lines).encode("utf-8")
+            lines, size = [], 0
+    if lines:
+        lines.append("")
+        yield "\n".join(lines).encode("utf-8")
+
+
+def binary_chunks(file, table, *, chunk_size=CHUNK_SIZE):
+    # the records are copied as they are, nothing is decoded besides the cell headers
+    parts, size = [], 0
+    for page in file.iter_leaves(table, cache=False):
+        for i in range(page.cell_number):
+            cell = page.cell(i)
+            payload = page.raw_payload(cell, file.source)
+            parts.append(BINARY_ROW.pack(cell['rowid'], len(payload)))
+            parts.append(payload)
+            size += BINARY_ROW.size + len(payload)
+            if size >= chunk_size:
+                yield b''.join(parts)
+                parts, size = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def read_binary(f):
+    # rows of a binary export, as (rowid, values)
+    from binary_reader.sqlite3_schema import read_record
+    while True:
+        head = f.read(BINARY_ROW.size)
+        if len(head) < BINARY_ROW.size:
+            return
+        rowid, size = BINARY_ROW.unpack(head)
+        yield rowid, read_record(f.read(size))
+
+
+def write_chunks(chunks, out, *, pipeline=False):
+    if not pipeline:
+        for chunk in chunks:
+            out.write(chunk)
+        return
+    # encode in this thread while another one writes, the file write releases the gil
+    pending = queue.Queue(PIPELINE_DEPTH)
+    errors = []
+
+    def writer():
+        while True:
+            chunk = pending.get()
+            if chunk is None:
+                return
+            if not errors:
+                try:
+                    out.write(chunk)
+                except BaseException as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=writer, name="export-writer", daemon=True)
+    thread.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            pending.put(chunk)
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def export(file, table, out, *, format="csv", columns=None, rowid=False, workers=None, pipeline=False,
+           chunk_size=CHUNK_SIZE):
+    if file.root_page(table) is None:
+        raise ValueError("no table %r" % (table,))
+    if format == "binary":
+        if columns is not None or workers is not None:
+            raise ValueError("binary export copies whole records, without columns or workers")
+        chunks = binary_chunks(file, table, chunk_size=chunk_size)
+    elif format in ("csv", "jsonl"):
+        rows = iter_rows(file, table, columns=columns, workers=workers)
+        encode = csv_chunks if format == "csv" else jsonl_chunks
+        chunks = encode(rows, rowid=rowid, chunk_size=chunk_size)
+    else:
+        raise ValueError("unknown format %r" % (format,))
+    counts = {"chunks": 0, "bytes": 0}
+
+    def counted(chunks):
+        for chunk in chunks:
+            counts["chunks"] += 1
+            counts["bytes"] += len(chunk)
+            yield chunk
+
+    write_chunks(counted(chunks), out, pipeline=pipeline)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="export a table of a sqlite3 database in rowid order")
+    parser.add_argument("database")
+    parser.add_argument("table")
+    parser.add_argument("--format", "-f", default="csv", choices=FORMATS)
+    parser.add_argument("--output", "-o", help="defaults to stdout")
+    parser.add_argument("--columns", nargs="+", type=int, help="indexes of the columns to export")
+    parser.add_argument("--rowid", action="store_true", help="write the rowid as the first column")
+    parser.add_argument("--workers", type=int, help="decode in that many processes")
+    parser.add_argument("--pipeline", action="store_true", help="write from a separate thread")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes per write")
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--prefetch", type=int, default=0, help="pages read ahead during the traversal")
+    args = parser.parse_args(argv)
+    if args.format == "binary" and (args.columns is not None or args.workers is not None):
+        parser.error("--format binary copies whole records, without --columns or --workers")
+    file = SQLiteFile.open(args.database, mmap=args.mmap, prefetch=args.prefetch)
+    if file.root_page(args.table) is None:
+        file.close()
+        parser.error("no table %r in %s" % (args.table, args.database))
+    start = time.perf_counter()
+    try:
+        if args.output:
+            with open(args.output, "wb") as out:
+                counts = export(file, args.table, out, format=args.format, columns=args.columns, rowid=args.rowid,
+                                workers=args.workers, pipeline=args.pipeline, chunk_size=args.chunk_size)
+        else:
+            counts = export(file, args.table, sys.stdout.buffer, format=args.format, columns=args.columns,
+                            rowid=args.rowid, workers=args.workers, pipeline=args.pipeline,
+                            chunk_size=args.chunk_size)
+            sys.stdout.buffer.flush()
+    finally:
+        file.close()
+    seconds = time.perf_counter() - start
+    print("%d bytes in %d chunks, %.3fs, %.1f MB/s" % (
+        counts["bytes"], counts["chunks"], seconds, counts["bytes"] / max(seconds, 1e-9) / 1e6), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
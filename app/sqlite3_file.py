@@ -1,123 +1,1114 @@
+import collections
+import functools
+import io
+import itertools
+import mmap as mmap_
+import os
+import struct
+import threading
 import binary_reader.sqlite3_schema as sqlite3
 
-class SQLiteFile:
+
+def numpy_support():
+    # imported on first use, numpy alone takes far longer to import than the reader itself
+    import binary_reader.sqlite3_numpy as sqlite3_numpy
+    return sqlite3_numpy
+
+
+def sort_key(value):
+    # sqlite3 ordering with BINARY collation: NULL < numbers < TEXT < BLOB
+    if value is None:
+        return 0, 0
+    if isinstance(value, (int, float)):
+        return 1, value
+    if isinstance(value, str):
+        return 2, value
+    return 3, bytes(value)
+
+
+def index_key(key):
+    if key is None:
+        return None
+    if not isinstance(key, (tuple, list)):
+        key = (key,)
+    return tuple(sort_key(v) for v in key)
+
+
+class FileSource:
+    def __init__(self, file, *, zero_copy=False):
+        self.file = file
+        self.zero_copy = zero_copy
+        self.lock = threading.Lock()
+        try:
+            self.fileno = file.fileno() if hasattr(os, "pread") else None
+        except (AttributeError, OSError):
+            self.fileno = None
+
+    def read(self, offset, size):
+        # positional reads leave the shared file offset alone, so threads never interleave seek and read
+        if self.fileno is not None:
+            bin_ = os.pread(self.fileno, size, offset)
+        else:
+            with self.lock:
+                self.file.seek(offset)
+                bin_ = self.file.read(size)
+        return memoryview(bin_) if self.zero_copy else bin_
+
+    def close(self):
+        self.file.close()
+
+
+class MmapSource:
     def __init__(self, file):
         self.file = file
-        self.pages = {}
+        self.mmap = mmap_.mmap(file.fileno(), 0, access=mmap_.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+    def read(self, offset, size):
+        return self.view[offset:offset + size]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def remap(self):
+        # the database grew or shrank since it was mapped, views already handed out keep the old mapping alive
+        if os.fstat(self.file.fileno()).st_size != len(self.mmap):
+            self.mmap = mmap_.mmap(self.file.fileno(), 0, access=mmap_.ACCESS_READ)
+            self.view = memoryview(self.mmap)
+
+
+def wal_checksum(bin_, s0, s1, big_endian):
+    # https://www.sqlite.org/fileformat2.html#checksum_algorithm
+    words = struct.unpack_from(("!%dI" if big_endian else "<%dI") % (len(bin_) // 4), bin_)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xffffffff
+        s1 = (s1 + words[i + 1] + s0) & 0xffffffff
+    return s0, s1
+
+
+class WalIndex:
+    # https://www.sqlite.org/fileformat2.html#walformat
+    # page index -> offset of the data of its latest committed frame in the -wal file
+    HEADER_SIZE = 32
+    FRAME_HEADER_SIZE = 24
+    MAGIC = (0x377f0682, 0x377f0683)
+    READ_FRAMES = 256
+
+    def __init__(self, path, *, zero_copy=False):
+        self.path = path
+        self.zero_copy = zero_copy
+        self.source = None
+        self.stat = None
+        # (header, frames, source) as read by the last update, swapped in one assignment for concurrent readers
+        self.state = (None, {}, None)
+        self.end = WalIndex.HEADER_SIZE
+        self.checksum = None
+        self.db_size = None
+
+    @property
+    def header(self):
+        return self.state[0]
+
+    @property
+    def frames(self):
+        return self.state[1]
+
+    def close(self):
+        source, self.source, self.state = self.source, None, (None, {}, None)
+        if source is not None:
+            source.close()
+
+    def reopen(self):
+        # the writer deletes the log when the last connection closes and creates a new file later on,
+        # a replaced file is only closed by update once no reader can pick it from state anymore
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.drop_source()
+            return False
+        if self.source is None or (stat.st_dev, stat.st_ino) != self.stat:
+            self.drop_source()
+            try:
+                self.source = FileSource(open(self.path, "rb"), zero_copy=self.zero_copy)
+            except FileNotFoundError:
+                return False
+            self.stat = (stat.st_dev, stat.st_ino)
+        return True
+
+    def drop_source(self):
+        if self.source is not None and self.source is not self.state[2]:
+            self.source.close()
+        self.source = None
+
+    def update(self):
+        # read the frames committed since the last update, returns the pages they changed and whether the log
+        # was restarted, removed or replaced: then frames never seen here may already be in the database file
+        old_header, old_frames, old_source = self.state
+        header = self.check_header(self.source.read(0, WalIndex.HEADER_SIZE)) if self.reopen() else None
+        if header != old_header:
+            restarted, changed, frames = old_header is not None or bool(old_frames), set(old_frames), {}
+            self.end, self.checksum, self.db_size = WalIndex.HEADER_SIZE, header and header[-2:], None
+        else:
+            restarted, changed, frames = False, set(), old_frames
+        if header is not None:
+            committed = self.read_frames(header)
+            if committed:
+                frames = dict(frames)
+                frames.update(committed)
+            changed.update(committed)
+        self.state = (header, frames, self.source if header is not None else None)
+        if old_source is not None and old_source is not self.state[2] and old_source is not self.source:
+            old_source.close()
+        return changed, restarted
+
+    def check_header(self, bin_):
+        if len(bin_) < WalIndex.HEADER_SIZE:
+            return None
+        magic, version, page_size, sequence, salt1, salt2, c0, c1 = struct.unpack("!8I", bin_)
+        if magic not in WalIndex.MAGIC or (c0, c1) != wal_checksum(bin_[:24], 0, 0, magic & 1):
+            sqlite3.report("wal", "header", 0, (magic, version))
+            return None
+        return magic, page_size, sequence, salt1, salt2, c0, c1
+
+    def read_frames(self, header):
+        # frames of a transaction only count once its commit frame is read, the rest is read again next time
+        magic, page_size, _, salt1, salt2, _, _ = header
+        frame_size = WalIndex.FRAME_HEADER_SIZE + page_size
+        committed, pending = {}, {}
+        offset, checksum = self.end, self.checksum
+        while True:
+            data = self.source.read(offset, frame_size * WalIndex.READ_FRAMES)
+            count = len(data) // frame_size
+            for k in range(count):
+                frame = data[k * frame_size:(k + 1) * frame_size]
+                page, db_size, salt1_, salt2_, c0, c1 = struct.unpack_from("!6I", frame)
+                if (salt1_, salt2_) != (salt1, salt2):
+                    return committed
+                checksum = wal_checksum(frame[WalIndex.FRAME_HEADER_SIZE:],
+                                        *wal_checksum(frame[:8], *checksum, magic & 1), magic & 1)
+                if checksum != (c0, c1):
+                    return committed
+                offset += frame_size
+                pending[page - 1] = offset - page_size
+                if db_size:
+                    committed.update(pending)
+                    pending.clear()
+                    self.end, self.checksum, self.db_size = offset, checksum, db_size
+            if count < WalIndex.READ_FRAMES:
+                return committed
+
+
+class WalSource:
+    # reads of the database file with the pages committed to the -wal file laid over it
+    def __init__(self, source, wal):
+        self.source = source
+        self.wal = wal
+
+    def read(self, offset, size):
+        header, frames, wal = self.wal.state
+        if not frames:
+            return self.source.read(offset, size)
+        page_size = header[1]
+        parts = []
+        cur, end = offset, offset + size
+        while cur < end:
+            index, start = divmod(cur, page_size)
+            stop = min(end, (index + 1) * page_size)
+            frame = frames.get(index)
+            if frame is None:
+                while stop < end and stop // page_size not in frames:
+                    stop = min(end, stop + page_size)
+                parts.append(self.source.read(cur, stop - cur))
+            else:
+                parts.append(wal.read(frame + start, stop - cur))
+            cur = stop
+        if len(parts) == 1:
+            return parts[0]
+        bin_ = b''.join(parts)
+        return memoryview(bin_) if self.wal.zero_copy else bin_
+
+    def close(self):
+        self.wal.close()
+        self.source.close()
+
+
+class PageCache:
+    # what SQLiteFile needs of a page_cache: get(index), put(index, page), pop(index), clear(), `index in`,
+    # iterating over the cached indexes and peek(index), a get that does not count nor reorder, for refresh().
+    # put may also set page.cache to itself, then the page calls cache.resize(index, delta) when it loads
+    # payloads, a cache that leaves page.cache unset does not need resize
+    def __init__(self, max_pages=None, max_bytes=None):
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.pages = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, index):
+        with self.lock:
+            return self._get(index)
+
+    def _get(self, index):
+        entry = self.pages.get(index)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pages.move_to_end(index)
+        return entry[0]
+
+    def peek(self, index):
+        # without counting a hit or a miss, nor moving the page in the lru order
+        entry = self.pages.get(index)
+        return None if entry is None else entry[0]
+
+    def put(self, index, page):
+        with self.lock:
+            self.pop(index)
+            nbytes = page.nbytes
+            self.pages[index] = (page, nbytes)
+            self.bytes += nbytes
+            page.cache = self
+            self.evict()
+
+    def resize(self, index, delta):
+        # a cached page loaded delta more bytes of payloads
+        with self.lock:
+            entry = self.pages.get(index)
+            if entry is None:
+                return
+            self.pages[index] = (entry[0], entry[1] + delta)
+            self.bytes += delta
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while len(self.pages) > 1 and (
+                    (self.max_pages is not None and len(self.pages) > self.max_pages) or
+                    (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                _, (page, nbytes) = self.pages.popitem(last=False)
+                self.bytes -= nbytes
+                self.evictions += 1
+                page.cache = None
+
+    def pop(self, index):
+        with self.lock:
+            entry = self.pages.pop(index, None)
+            if entry is None:
+                return None
+            self.bytes -= entry[1]
+            entry[0].cache = None
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            for page, _ in self.pages.values():
+                page.cache = None
+            self.pages.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pages": len(self.pages),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __contains__(self, index):
+        return index in self.pages
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.pages))
+
+
+class SQLiteFile:
+    def __init__(self, file, *, zero_copy=False, mmap=False, page_cache=None, numpy=False, prefetch=0, wal=None):
+        if numpy and numpy_support().np is None:
+            raise ImportError("numpy is required for numpy=True")
+        self.file = file
+        self.options = {"zero_copy": zero_copy, "mmap": mmap, "numpy": numpy, "prefetch": prefetch, "wal": wal}
+        self.numpy = numpy
+        self.file_source = MmapSource(file) if mmap else FileSource(file, zero_copy=zero_copy)
+        self.source = self.file_source
+        self.wal = None
+        if wal is not None:
+            # wal is the path of the -wal file, it does not need to exist yet
+            self.wal = WalIndex(wal, zero_copy=zero_copy)
+            self.wal.update()
+            self.source = WalSource(self.file_source, self.wal)
+        # a PageCache or an object with the same interface, see PageCache
+        self.pages = PageCache() if page_cache is None else page_cache
+        self.prefetch = prefetch
+        self.prefetched = collections.OrderedDict()
+        self.prefetch_lock = threading.Lock()
         self.load()
 
+    @classmethod
+    def open(cls, path, *, wal=True, **kwargs):
+        # wal=True reads <path>-wal, a string is the path of the -wal file, False or None the database file alone
+        if wal is True:
+            wal = path + "-wal"
+        return cls(open(path, "rb"), wal=wal or None, **kwargs)
+
+    def close(self):
+        self.pages.clear()
+        self.prefetched.clear()
+        self.source.close()
+
     def load(self):
-        self.file.seek(0)
-        self.config = self.readbin("header_schema", self.file.read(100))
+        self.config = self.readbin("header_schema", self.source.read(0, 100))
+        self.file_state = self.read_file_state()
         self.tables = self.load_btree(0)
 
-    def load_btree(self, index):
-        if isinstance(index, str):
+    def read_file_state(self):
+        # of the database file itself: in wal mode it is only written by checkpoints, which do not always
+        # copy page 1 (and its change counter) back, so its size and mtime are compared as well
+        try:
+            stat = os.fstat(self.file.fileno())
+            stat = stat.st_size, stat.st_mtime_ns
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            stat = None
+        return sqlite3.schemas["header_schema"].read_field(self.file_source.read(0, 100), "change_counter"), stat
+
+    def refresh(self):
+        # pick up what other processes committed since the last load or refresh, returns the indexes of the
+        # changed pages, which are dropped from the page cache while every other cached page is kept
+        self.prefetched.clear()
+        if isinstance(self.file_source, MmapSource):
+            self.file_source.remap()
+        changed, restarted = self.wal.update() if self.wal is not None else (set(), False)
+        file_state = self.read_file_state()
+        if restarted or file_state != self.file_state:
+            # the database file itself was written, compare the cached pages with what is there now; pages read
+            # from a mapping already show the new content, so those can only be dropped
+            for index in self.pages:
+                page = self.pages.peek(index)
+                if isinstance(self.file_source, MmapSource) or (
+                        page is not None and page.page_bin != self.read_page(index)):
+                    changed.add(index)
+        self.file_state = file_state
+        for index in self.pages:
+            page = self.pages.peek(index)
+            if page is not None and not changed.isdisjoint(page.overflow_pages()):
+                changed.add(index)
+        for index in changed:
+            self.pages.pop(index)
+        if 0 in changed:
+            self.load()
+        return changed
+
+    def root_page(self, table):
+        if isinstance(table, str):
             for _, v in self.tables:
-                if v[1] == index:
-                    print("found", v)
-                    return self.load_btree(v[3]-1)
+                if v[1] == table:
+                    return v[3] - 1
+            return None
+        return table
+
+    def load_btree(self, index):
+        return list(self.iter_rows(index, cache=True))
+
+    def iter_rows(self, table, *, columns=None, cache=False):
+        return self.iter_range(table, columns=columns, cache=cache)
+
+    def iter_range(self, table, lo=None, hi=None, *, columns=None, cache=True):
+        index = self.root_page(table)
+        if index is None:
+            return
+        stack = [index]
+        while stack:
+            page = self.pop_page(stack, cache=cache)
+            page_type = page.header['page_type']
+            start = 0 if lo is None else page.search(lo)
+            if page_type == 13:
+                for rowid, values in page.leaf_rows(start, columns, numpy=self.numpy):
+                    if hi is not None and rowid >= hi:
+                        return
+                    yield rowid, values
+            elif page_type == 5:
+                end = page.cell_number if hi is None else page.search(hi)
+                for i in range(end, start - 1, -1):
+                    stack.append(page.child(i))
+            else:
+                sqlite3.report("page_type", page.index, 0, page_type)
+
+    def iter_leaves(self, table, *, cache=False):
+        index = self.root_page(table)
+        if index is None:
+            return
+        stack = [index]
+        while stack:
+            page = self.pop_page(stack, cache=cache)
+            page_type = page.header['page_type']
+            if page_type == 13:
+                yield page
+            elif page_type == 5:
+                for i in range(page.cell_number, -1, -1):
+                    stack.append(page.child(i))
+            else:
+                sqlite3.report("page_type", page.index, 0, page_type)
+
+    def leaf_pages(self, table):
+        index = self.root_page(table)
+        if index is None:
             return []
+        level = [index]
+        while self.load_btree_page(level[0]).header['page_type'] == 5:
+            children = []
+            for n, index in enumerate(level):
+                if index not in self.prefetched:
+                    self.prefetch_pages(level[n:n + self.prefetch])
+                page = self.load_btree_page(index)
+                children += [page.child(i) for i in range(page.cell_number + 1)]
+            level = children
+        return level
+
+    def parallel_scan(self, table, workers=None, *, columns=None, ordered=True, chunk_pages=64):
+        import concurrent.futures
+        path = getattr(self.file, "name", None)
+        if not isinstance(path, str):
+            raise ValueError("parallel_scan needs a SQLiteFile opened from a path")
+        workers = workers or os.cpu_count() or 1
+        leaves = self.leaf_pages(table)
+        chunks = [leaves[i:i + chunk_pages] for i in range(0, len(leaves), chunk_pages)]
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                    initargs=(path, self.options)) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_scan_leaves, chunk, columns))
+                if len(pending) < workers * 2:
+                    continue
+                if ordered:
+                    yield from pending.popleft().result()
+                else:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield from future.result()
+            if ordered:
+                for future in pending:
+                    yield from future.result()
+            else:
+                for future in concurrent.futures.as_completed(pending):
+                    yield from future.result()
+
+    def scan_columns(self, table, columns, *, batch_rows=65536, cache=False):
+        sqlite3_numpy = numpy_support()
+        if sqlite3_numpy.np is None:
+            raise ImportError("numpy is required for scan_columns")
+        batch = sqlite3_numpy.ColumnBatch(columns, batch_rows)
+        for page in self.iter_leaves(table, cache=cache):
+            start, stop = 0, page.cell_number
+            layout = page.layout() if page.consistent else None
+            while start < stop:
+                end = min(stop, start + batch.free)
+                at = batch.count
+                if layout is None:
+                    for i in range(start, end):
+                        batch.set_row(at + i - start, *page.row(i, columns))
+                    batch.count += end - start
+                else:
+                    batch.add_layout(page.page_bin, layout, start, end)
+                    for i in (~layout.regular[start:end]).nonzero()[0].tolist():
+                        batch.set_row(at + i, *page.row(start + i, columns))
+                start = end
+                if batch.free == 0:
+                    yield batch.finish()
+                    batch = sqlite3_numpy.ColumnBatch(columns, batch_rows)
+        if batch.count:
+            yield batch.finish()
+
+    def get_row(self, table, rowid, *, columns=None):
+        for _, values in self.iter_range(table, rowid, rowid + 1, columns=columns):
+            return values
+        return None
+
+    def open_blob(self, table, rowid, column):
+        index = self.root_page(table)
+        if index is None:
+            return None
         page = self.load_btree_page(index)
-        rows = []
-        page_type = page.header['page_type']
-        if page_type == 13:
-            for c, p in zip(page.cells, page.payloads):
-                rows.append((c['rowid'], p['column_contents']))
-        elif page_type == 5:
-            for c in page.cells:
-                print("load btree page %s -> %s, %s" % (index+1, c['left_child_page'], c['rowid']))
-                rows += self.load_btree(c['left_child_page']-1)
-            print("load btree page %s -> %s, -1" % (index+1, page.header['right_most_page']))
-            rows += self.load_btree(page.header['right_most_page']-1)
-        else:
-            print("unknown page type %s" % page_type)
-        return rows
+        while page.header['page_type'] == 5:
+            page = self.load_btree_page(page.child(page.search(rowid)))
+        i = page.search(rowid)
+        if i == page.cell_number or page.cell(i)['rowid'] != rowid:
+            return None
+        return page.blob(i, column)
+
+    def index_table(self, index):
+        for _, v in self.tables:
+            if v[0] == 'index' and v[1] == index:
+                return v[2]
+        return None
+
+    def iter_index(self, index, lo=None, hi=None, *, cache=True):
+        # lo and hi are inclusive bounds compared against the leading columns of each entry
+        lo, hi = index_key(lo), index_key(hi)
+        root = self.root_page(index)
+        if root is None:
+            return
+        stack = [root]
+        while stack:
+            item = stack.pop()
+            if not isinstance(item, int):
+                yield item
+                continue
+            stack.append(item)
+            page = self.pop_page(stack, cache=cache)
+            page_type = page.header['page_type']
+            start = 0 if lo is None else page.search_key(lo)
+            end = page.cell_number if hi is None else page.search_key(hi, upper=True)
+            if page_type == 10:
+                for i in range(end - 1, start - 1, -1):
+                    stack.append(page.payload(i)['column_contents'])
+            elif page_type == 2:
+                stack.append(page.child(end))
+                for i in range(end - 1, start - 1, -1):
+                    stack.append(page.payload(i)['column_contents'])
+                    stack.append(page.child(i))
+            else:
+                sqlite3.report("page_type", page.index, 0, page_type)
+
+    def lookup(self, index, key):
+        if not isinstance(key, (tuple, list)):
+            key = (key,)
+        return [entry[-1] for entry in self.iter_index(index, key, key)]
+
+    def find_rows(self, index, key):
+        table = self.index_table(index)
+        for rowid in self.lookup(index, key):
+            yield rowid, self.get_row(table, rowid)
+
+    def load_btree_page(self, index, *, cache=True):
+        page = self.pages.get(index)
+        if page is None:
+            page = Page(self.config, self.read_page(index), index, source=self.source)
+            if cache:
+                self.pages.put(index, page)
+        return page
+
+    def read_page(self, index):
+        if self.prefetched:
+            with self.prefetch_lock:
+                page_bin = self.prefetched.pop(index, None)
+            if page_bin is not None:
+                return page_bin
+        return self.source.read(index * self.config['page_size'], self.config['page_size'])
 
-    def load_btree_page(self, index):
-        if index in self.pages:
-            return self.pages[index]
-        self.file.seek(index * self.config['page_size'])
-        self.pages[index] = Page(self.config, self.file.read(self.config['page_size']), index, file=self.file)
-        return self.pages[index]
+    def pop_page(self, stack, *, cache=True):
+        # read ahead the next pages the traversal will visit, the top of the stack is visited first
+        index = stack.pop()
+        if self.prefetch and index not in self.prefetched and index not in self.pages:
+            self.prefetch_pages([index] + [i for i in stack[:-self.prefetch:-1] if isinstance(i, int)])
+        return self.load_btree_page(index, cache=cache)
+
+    def prefetch_pages(self, indexes):
+        # read the first `prefetch` pages not loaded yet, sorted and merged into runs of adjacent pages
+        # so that each run is fetched with a single read
+        if not self.prefetch:
+            return
+        indexes = [i for i in dict.fromkeys(indexes) if i not in self.pages and i not in self.prefetched]
+        runs = []
+        for index in sorted(indexes[:self.prefetch]):
+            if runs and runs[-1][0] + runs[-1][1] == index:
+                runs[-1][1] += 1
+            else:
+                runs.append([index, 1])
+        page_size = self.config['page_size']
+        for start, count in runs:
+            data = self.source.read(start * page_size, count * page_size)
+            with self.prefetch_lock:
+                for j in range(len(data) // page_size):
+                    self.prefetched[start + j] = data[j * page_size:(j + 1) * page_size]
+                while len(self.prefetched) > self.prefetch * 4:
+                    self.prefetched.popitem(last=False)
+
+    @staticmethod
+    def read_header_fields(path, *names):
+        # a few database header fields without opening the file as a SQLiteFile
+        with open(path, "rb") as f:
+            header = f.read(100)
+        schema = sqlite3.schemas["header_schema"]
+        return {name: schema.read_field(header, name) for name in names}
 
     @staticmethod
-    def readbin(schema, bin_, *, cache=None):
+    def readbin(schema, bin_, *, cache=None, offset=0):
         if cache is None:
             cache = {}
         if isinstance(schema, str):
-            schema = sqlite3.schemas[schema].format
-        return dict(sqlite3.read_schema_list(schema, bin_, table=sqlite3.format_table, cache=cache))
+            schema = sqlite3.schemas[schema]
+        if isinstance(schema, sqlite3.Schema):
+            if schema.decoder is not None:
+                return schema.decoder(bin_, cache, offset)
+            schema = schema.format
+        return dict(sqlite3.read_schema_list(schema, bin_, offset=offset, table=sqlite3.format_table, cache=cache))
+
+
+class AsyncSQLiteFile:
+    # asyncio front end of a SQLiteFile: page reads and row decoding run in an executor, off the event loop
+    def __init__(self, file, *, executor=None):
+        self.file = file
+        self.executor = executor
+
+    @classmethod
+    async def open(cls, path, *, executor=None, **kwargs):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        file = await loop.run_in_executor(executor, functools.partial(SQLiteFile.open, path, **kwargs))
+        return cls(file, executor=executor)
+
+    async def close(self):
+        await self.run(self.file.close)
+
+    async def refresh(self):
+        return await self.run(self.file.refresh)
+
+    async def run(self, func, *args, **kwargs):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def load_btree_page(self, index, *, cache=True):
+        if index in self.file.pages:
+            page = self.file.pages.get(index)
+            if page is not None:
+                return page
+        return await self.run(self.file.load_btree_page, index, cache=cache)
+
+    def load_btree_pages(self, indexes, *, cache=True):
+        # request all pages at once, the futures are returned in the order of indexes
+        import asyncio
+        return [asyncio.ensure_future(self.load_btree_page(i, cache=cache)) for i in indexes]
+
+    async def get_row(self, table, rowid, *, columns=None):
+        index = self.file.root_page(table)
+        if index is None:
+            return None
+        page = await self.load_btree_page(index)
+        while page.header['page_type'] == 5:
+            page = await self.load_btree_page(page.child(page.search(rowid)))
+        if page.header['page_type'] != 13:
+            sqlite3.report("page_type", page.index, 0, page.header['page_type'])
+            return None
+        i = page.search(rowid)
+        if i == page.cell_number or page.cell(i)['rowid'] != rowid:
+            return None
+        _, values = await self.run(page.row, i, columns)
+        return values
+
+    def iter_rows(self, table, *, columns=None, cache=False):
+        return self.iter_range(table, columns=columns, cache=cache)
+
+    async def iter_range(self, table, lo=None, hi=None, *, columns=None, cache=True):
+        index = self.file.root_page(table)
+        if index is None:
+            return
+        stack = self.load_btree_pages([index], cache=cache)
+        try:
+            while stack:
+                page = await stack.pop()
+                page_type = page.header['page_type']
+                start = 0 if lo is None else page.search(lo)
+                end = page.cell_number if hi is None else page.search(hi)
+                if page_type == 13:
+                    rows = await self.run(lambda: list(itertools.islice(
+                        page.leaf_rows(start, columns, numpy=self.file.numpy), max(end - start, 0))))
+                    for row in rows:
+                        yield row
+                elif page_type == 5:
+                    stack += reversed(self.load_btree_pages([page.child(i) for i in range(start, end + 1)],
+                                                            cache=cache))
+                else:
+                    sqlite3.report("page_type", page.index, 0, page_type)
+        finally:
+            for future in stack:
+                future.cancel()
 
 
 class Page:
-    def __init__(self, config, page_bin, index, *, file=None):
+    UNLOADED = object()
+    NUMPY_MIN_CELLS = 8
+    OVERFLOW_READ_AHEAD = 8
+
+    def __init__(self, config, page_bin, index, *, source=None):
         self.config = config
         self.page_bin = page_bin
         self.index = index
+        self.source = source
+        self.payload_bytes = 0
+        self.cache = None
+        self._layout = None
         self.load(index == 0)
+
+    @property
+    def nbytes(self):
+        return len(self.page_bin) + self.payload_bytes
+
+    @property
+    def cell_number(self):
+        return len(self._cells)
+
+    @property
+    def cells(self):
         self.load_cells()
-        self.load_cells_payload(file)
+        return self._cells
+
+    @property
+    def payloads(self):
+        self.load_cells_payload()
+        return self._payloads
 
     def load(self, first=False):
-        self.header = SQLiteFile.readbin("page_header_schema", self.page_bin[100:] if first else self.page_bin)
+        self.header = SQLiteFile.readbin("page_header_schema", self.page_bin, offset=100 if first else 0)
+        self.cell_cache = self.header.copy()
+        self.cell_cache['config'] = self.config
+        # a page that is no longer a b-tree page, e.g. reached through a parent read before a refresh, has no offsets
+        self._cells = [None] * len(self.header.get('cell_offset_array') or ())
+        self._payloads = [Page.UNLOADED] * len(self._cells)
+        # cells are counted by the offsets actually read, the header count is only trusted when they agree
+        self.consistent = len(self._cells) == self.header.get('cell_number')
+        if not self.consistent:
+            sqlite3.report("cell_number", self.index, 0, (self.header.get('cell_number'), len(self._cells)))
         return self
 
+    def cell(self, i):
+        cell = self._cells[i]
+        if cell is None:
+            offset = self.header['cell_offset_array'][i]
+            # decode with a private copy of the page header cache, other threads may be decoding cells of this page
+            cell = self._cells[i] = SQLiteFile.readbin("cell_header_schema", self.page_bin,
+                                                       cache=self.cell_cache.copy(), offset=offset)
+        return cell
+
+    def child(self, i):
+        if i == self.cell_number:
+            return self.header['right_most_page'] - 1
+        return self.cell(i)['left_child_page'] - 1
+
+    def search(self, rowid):
+        lo, hi = 0, self.cell_number
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.cell(mid)['rowid'] < rowid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def search_key(self, key, upper=False):
+        lo, hi = 0, self.cell_number
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = index_key(self.payload(mid)['column_contents'][:len(key)])
+            if probe < key or (upper and probe == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def payload(self, i, source=None):
+        payload = self._payloads[i]
+        if payload is Page.UNLOADED:
+            payload = self._payloads[i] = self.load_payload(self.cell(i), source or self.source)
+        return payload
+
+    def layout(self):
+        if self._layout is None:
+            self._layout = numpy_support().decode_leaf_page(self.page_bin, 100 if self.index == 0 else 0,
+                                                          self.config['page_size'])
+        return self._layout
+
+    def leaf_rows(self, start=0, columns=None, *, numpy=False):
+        if numpy and self.consistent and self.cell_number - start >= Page.NUMPY_MIN_CELLS:
+            yield from self.leaf_rows_numpy(start, columns)
+            return
+        for i in range(start, self.cell_number):
+            yield self.row(i, columns)
+
+    def row(self, i, columns=None):
+        if columns is None:
+            return self.cell(i)['rowid'], self.payload(i)['column_contents']
+        return self.cell(i)['rowid'], self.record(i, columns)
+
+    def leaf_rows_numpy(self, start=0, columns=None):
+        layout = self.layout()
+        rowids = layout.rowid[start:].tolist()
+        regular = layout.regular[start:].tolist()
+        serial_types = layout.serial_types[start:].tolist()
+        offsets = layout.column_offsets[start:].tolist()
+        column_number = layout.column_number[start:].tolist()
+        for i, rowid in enumerate(rowids):
+            if not regular[i]:
+                yield self.row(start + i, columns)
+                continue
+            types, offset = serial_types[i], offsets[i]
+            selected = range(column_number[i]) if columns is None else columns
+            yield rowid, [sqlite3.read_value(self.page_bin, offset[c], types[c])[1] if c < column_number[i] else None
+                          for c in selected]
+
+    def overflow_pages(self):
+        # of the payloads loaded in full, a change to any of them makes this page stale too
+        return [page for cell in self._cells if cell is not None for page in cell.get('overflow_pages', ())]
+
     def load_cells(self):
-        self.cells = []
-        cache = self.header.copy()
-        cache['config'] = self.config
-        for i in self.header['cell_offset_array']:
-            self.cells.append(SQLiteFile.readbin("cell_header_schema", self.page_bin[i:], cache=cache))
+        for i, cell in enumerate(self._cells):
+            if cell is None:
+                self.cell(i)
         return self
 
-    def load_overflows(self, file, cell=None):
+    def load_overflows(self, source, cell=None):
         if cell is None:
             for i in self.cells:
-                self.load_overflows(file, i)
+                self.load_overflows(source, i)
         elif cell['payload_size'] > cell['local_payload_size']:
-            cell['overflow_pages'], cell['full_payload'] = self.load_overflow(file, cell['payload_size'],
+            if cell.get('overflow_page') is None:
+                # the cell ends before its overflow pointer, the local part is all there is of the payload
+                sqlite3.report("overflow", self.index, None, "no overflow page")
+                cell['overflow_pages'], cell['full_payload'] = [], [cell['payload']]
+                return
+            cell['overflow_pages'], cell['full_payload'] = self.load_overflow(source, cell['payload_size'],
                                                                               cell['overflow_page'] - 1,
                                                                               size=cell['local_payload_size'],
                                                                               acc=[cell['payload']])
 
-    def load_overflow(self, file, total_size, acc_page, size=0, acc=None):
+    def load_overflow(self, source, total_size, acc_page, size=0, acc=None):
         if acc is None:
             acc = []
         if not isinstance(acc_page, list):
             acc_page = [acc_page]
-        if acc_page[-1] == 0:
-            return acc_page, acc
-        file.seek(acc_page[-1] * self.config['page_size'])
-        page_bin = file.read(self.config['page_size'])
-        page_header = SQLiteFile.readbin("page_overflow_header_schema", page_bin)
-        # print("load overflow %s -> %s" % (acc_page, page_header))
-        offset = page_header['offset']
-        content = page_bin[offset:max(offset + total_size - size, 0)]
-        acc.append(content)
-        acc_page.append(page_header['next_page'] - 1)
-        size += len(content)
-        if size >= total_size:
+        if acc_page[-1] < 0:
             return acc_page, acc
-        return self.load_overflow(file, total_size, acc_page, acc)
+        chain = OverflowChain(source, self.config['page_size'], acc_page[-1], total_size - size,
+                              read_ahead=Page.OVERFLOW_READ_AHEAD)
+        k = 0
+        while size < total_size:
+            content = chain.chunk(k)[:total_size - size]
+            if not content:
+                break
+            acc.append(content)
+            size += len(content)
+            k += 1
+        return acc_page[:-1] + chain.pages, acc
 
-    def load_cells_payload(self, file=None):
-        self.payloads = []
-        for i in self.cells:
-            if 'payload' not in i:
-                self.payloads.append(None)
-                continue
-            payload = i['payload']
-            if i['payload_size'] > i['local_payload_size']:
-                if 'full_payload' not in i and file is not None:
-                    self.load_overflows(file, i)
-                if 'full_payload' in i:
-                    payload = b''.join(i['full_payload'])
-                else:
-                    print("overflow not loaded %s" % i)
-            self.payloads.append(SQLiteFile.readbin("record_format_schema", payload))
+    def payload_reader(self, i, source=None):
+        return PayloadReader(self.cell(i), source or self.source, self.config['page_size'],
+                             read_ahead=Page.OVERFLOW_READ_AHEAD)
+
+    def record(self, i, columns=None, source=None):
+        cell = self.cell(i)
+        if columns is None or cell['payload_size'] <= cell['local_payload_size'] or 'full_payload' in cell:
+            return sqlite3.read_record(self.raw_payload(cell, source or self.source), columns)
+        # only walk the overflow chain as far as the selected columns need
+        reader = self.payload_reader(i, source)
+        positions = reader.record_header()
+        values = []
+        for c in columns:
+            if c < len(positions):
+                offset, serial_type = positions[c]
+                bin_ = reader.read(offset, sqlite3.serial_type_size(serial_type))
+                values.append(sqlite3.read_value(bin_, 0, serial_type)[1])
+            else:
+                values.append(None)
+        return values
+
+    def blob(self, i, column, source=None):
+        reader = self.payload_reader(i, source)
+        positions = reader.record_header()
+        if column >= len(positions) or positions[column][1] < 12:
+            return None
+        offset, serial_type = positions[column]
+        return BlobReader(reader, offset, sqlite3.serial_type_size(serial_type))
+
+    def load_cells_payload(self, source=None):
+        for i, payload in enumerate(self._payloads):
+            if payload is Page.UNLOADED:
+                self.payload(i, source)
         return self
 
+    def raw_payload(self, cell, source=None):
+        payload = cell['payload']
+        if cell['payload_size'] > cell['local_payload_size']:
+            if 'full_payload' not in cell and source is not None:
+                self.load_overflows(source, cell)
+            if 'full_payload' in cell:
+                payload = b''.join(cell['full_payload'])
+            else:
+                sqlite3.report("overflow", self.index, cell.get('overflow_page'), "overflow not loaded")
+        return payload
+
+    def load_payload(self, cell, source=None):
+        if 'payload' not in cell:
+            return None
+        payload = self.raw_payload(cell, source)
+        self.payload_bytes += cell['payload_size']
+        cache = self.cache
+        if cache is not None:
+            cache.resize(self.index, cell['payload_size'])
+        return SQLiteFile.readbin("record_format_schema", payload)
+
+
+class OverflowChain:
+    # follows the overflow pages of one payload, page k holds bytes k * (page_size - 4) onwards past the local part
+    def __init__(self, source, page_size, first_page, size, *, read_ahead=8):
+        self.source = source
+        self.page_size = page_size
+        self.read_ahead = read_ahead
+        self.count = -(-size // (page_size - 4))
+        self.pages = [first_page]
+        self.window = {}
+        self.run = 1
+
+    def link(self, page):
+        # read further ahead while the chain stays on consecutive pages
+        if page == self.pages[-1] + 1:
+            self.run = min(self.run * 2, self.read_ahead)
+        else:
+            self.run = 1
+        self.pages.append(page)
+
+    def fetch(self, k):
+        page = self.pages[k]
+        page_bin = self.window.pop(page, None)
+        if page_bin is None:
+            n = max(min(self.run, self.count - k), 1)
+            data = self.source.read(page * self.page_size, n * self.page_size)
+            self.window = {page + j: data[j * self.page_size:(j + 1) * self.page_size]
+                           for j in range(1, len(data) // self.page_size)}
+            page_bin = data[:self.page_size]
+        return page_bin
+
+    def locate(self, k):
+        # skipped pages only need their 4 byte next pointer
+        while len(self.pages) <= k and self.pages[-1] >= 0:
+            page = self.pages[-1]
+            page_bin = self.window.get(page)
+            if page_bin is None:
+                page_bin = self.source.read(page * self.page_size, 4)
+            self.link(int.from_bytes(page_bin[:4], "big") - 1)
+        return k < len(self.pages) and self.pages[k] >= 0
+
+    def chunk(self, k):
+        if not self.locate(k):
+            return b''
+        page_bin = self.fetch(k)
+        if k + 1 == len(self.pages):
+            self.link(int.from_bytes(page_bin[:4], "big") - 1)
+        return page_bin[4:]
+
+
+class PayloadReader:
+    # random access to the payload of a cell without loading more of the overflow chain than is read
+    def __init__(self, cell, source, page_size, *, read_ahead=8):
+        self.local = cell['payload']
+        self.size = cell['payload_size']
+        self.usable = page_size - 4
+        self.chain = None
+        if self.size > cell['local_payload_size']:
+            if cell.get('overflow_page') is None:
+                sqlite3.report("overflow", None, None, "no overflow page")
+                return
+            self.chain = OverflowChain(source, page_size, cell['overflow_page'] - 1, self.size - len(self.local),
+                                       read_ahead=read_ahead)
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        parts = []
+        if offset < len(self.local):
+            parts.append(self.local[offset:end])
+        pos = max(offset, len(self.local))
+        while pos < end and self.chain is not None:
+            k, inner = divmod(pos - len(self.local), self.usable)
+            content = self.chain.chunk(k)[inner:inner + end - pos]
+            if not content:
+                break
+            parts.append(content)
+            pos += len(content)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def record_header(self):
+        _, header_size = sqlite3.read_varint(self.read(0, 9), 0, None)
+        return sqlite3.read_record_header(self.read(0, header_size))
+
+
+class BlobReader(io.RawIOBase):
+    # file-like view of one TEXT or BLOB column, read in chunks from the payload
+    def __init__(self, payload, start, size):
+        super().__init__()
+        self.payload = payload
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def __len__(self):
+        return self.size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = max(min(size, self.size - self.pos), 0)
+        data = self.payload.read(self.start + self.pos, size) if size else b''
+        self.pos += len(data)
+        return bytes(data)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+_worker_file = None
+
+
+def _init_worker(path, options):
+    global _worker_file
+    _worker_file = SQLiteFile.open(path, **options)
+
+
+def _scan_leaves(leaves, columns):
+    rows = []
+    for index in leaves:
+        page = _worker_file.load_btree_page(index, cache=False)
+        for rowid, values in page.leaf_rows(0, columns, numpy=_worker_file.numpy):
+            rows.append((rowid, [bytes(v) if isinstance(v, memoryview) else v for v in values]))
+    return rows
+
 
 def _init_test():
     import sqlite3
@@ -0,0 +1,46 @@
+import hashlib
+import marshal
+import os
+import sys
+
+# compiled code objects of generated decoders and Ops, keyed by a hash of their source
+# set BINARY_READER_CACHE (or call enable) to also keep them on disk across processes
+directory = os.environ.get("BINARY_READER_CACHE") or None
+memory = {}
+
+
+def enable(path=None):
+    global directory
+    directory = path or os.path.join(os.path.expanduser("~"), ".cache", "binary_reader")
+    return directory
+
+
+def disable():
+    global directory
+    directory = None
+
+
+def compile_source(source, filename):
+    key = hashlib.sha1(("%s\0%s\0%s" % (sys.version, filename, source)).encode()).hexdigest()
+    code = memory.get(key)
+    if code is not None:
+        return code
+    path = os.path.join(directory, key + ".bin") if directory else None
+    if path is not None:
+        try:
+            with open(path, "rb") as f:
+                code = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            code = None
+    if code is None:
+        code = compile(source, filename, "exec")
+        if path is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(path + ".%d.tmp" % os.getpid(), "wb") as f:
+                    marshal.dump(code, f)
+                os.replace(path + ".%d.tmp" % os.getpid(), path)
+            except OSError:
+                pass
+    memory[key] = code
+    return code
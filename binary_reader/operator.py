@@ -1,5 +1,7 @@
 import struct
 
+from . import codecache
+
 
 class Size:
     ALL = set()
@@ -42,65 +44,56 @@ class Size:
         return (self.size, self.size_, self.deps).__repr__()
 
 class Op:
+    # a chain of steps over a cache dict, compiled into one flat function on first call
     def __init__(self):
-        self.funcs = []
+        self.steps = []
         self.deps = []
+        # set once a step may read any part of the cache, deps is then incomplete
+        self.opaque = False
+        self.compiled = None
 
     def in_(self, range):
-        return self._p(lambda x: x in self._get(range), [range])
+        return self._p(("in", range), [range])
 
     def eq(self, rhs):
-        return self._p(lambda x: x == self._get(rhs), [rhs])
+        return self._p(("eq", rhs), [rhs])
 
     def cache(self, name, raw=False):
         self.deps.append(name)
-        return self._p(lambda cache: cache[name] if raw else cache[name][2], [])
+        return self._p(("cache", name, raw), [])
 
     def cache_or(self, name, *, raw=False, default=None):
         self.deps.append(name)
-        return self._p(lambda cache: self._get(default) if name not in cache else cache[name] if raw else cache[name][2], [default])
+        return self._p(("cache_or", name, raw, default), [default])
 
     def caches(self, *args):
-        def _get(cache, i):
-            if isinstance(i, tuple):
-                for k in i:
-                    cache = cache[k]
-            else:
-                cache = cache[i]
-            return cache
-        self.deps += args
-        return self._p(self.wrap_failed(lambda cache: [_get(cache, i) for i in args]), [])
+        self.deps += [i[0] if isinstance(i, tuple) else i for i in args]
+        return self._p(("caches", args), [])
 
     def if_(self, true_cond, false_cond=None):
-        return self._p(lambda cond: self._get(true_cond) if cond else self._get(false_cond), [true_cond, false_cond])
+        return self._p(("if", true_cond, false_cond), [true_cond, false_cond])
 
     def apply(self, fun, deps=Size.ALL):
-        self.deps += deps
-        return self._p(lambda result: fun(*[self._get(i) for i in result]), [])
+        self._deps(deps)
+        return self._p(("apply", fun), [])
 
     def apply_(self, fun, deps=Size.ALL):
-        self.deps += deps
-        return self._p(fun, [])
-
-    def wrap_failed(self, fun):
-        def wrapped(*args, **kwargs):
-            try:
-                return fun(*args, **kwargs)
-            except:
-                return None
+        self._deps(deps)
+        return self._p(("call", fun), [])
 
-        return wrapped
-
-    def _get(self, i):
-        if isinstance(i, Op):
-            return i(self.input)
-        return i
+    def _deps(self, deps):
+        if deps is Size.ALL:
+            self.opaque = True
+        else:
+            self.deps += deps
 
-    def _p(self, func, deps):
+    def _p(self, step, deps):
         for i in deps:
             if isinstance(i, Op):
                 self.deps += Size.getdeps(i)
-        self.funcs.append(func)
+                self.opaque = self.opaque or i.opaque
+        self.steps.append(step)
+        self.compiled = None
         return self
 
     def debug(self, hint=""):
@@ -108,15 +101,58 @@ class Op:
             print("Op(%s): %s" % (hint, x))
             return x
 
-        return self._p(_debug)
+        return self._p(("call", _debug), [])
+
+    def compile(self):
+        if self.compiled is not None:
+            return self.compiled
+        env = {"Op": Op}
+
+        def value(x):
+            if x is None or type(x) in (int, str, bool):
+                return repr(x)
+            key = "V%d" % len(env)
+            if isinstance(x, Op):
+                env[key] = x.compile()
+                return "%s(input)" % key
+            env[key] = x
+            return key
+
+        lines = ["def op(input):", "    r = input"]
+        for step in self.steps:
+            kind, nullable = step[0], True
+            if kind == "in":
+                body, nullable = ["r = r in %s" % value(step[1])], False
+            elif kind == "eq":
+                body, nullable = ["r = r == %s" % value(step[1])], False
+            elif kind == "cache":
+                body = ["r = r[%s]%s" % (value(step[1]), "" if step[2] else "[2]")]
+            elif kind == "cache_or":
+                name = value(step[1])
+                body = ["r = %s if %s not in r else r[%s]%s" % (value(step[3]), name, name, "" if step[2] else "[2]")]
+            elif kind == "caches":
+                paths = ["r" + "".join("[%s]" % value(k) for k in (i if isinstance(i, tuple) else (i,)))
+                         for i in step[1]]
+                body = ["try:", "    r = [%s]" % ", ".join(paths), "except Exception:", "    return None"]
+                nullable = False
+            elif kind == "if":
+                body = ["r = %s if r else %s" % (value(step[1]), value(step[2]))]
+            elif kind == "apply":
+                body = ["r = %s(*r)" % value(step[1]), "if isinstance(r, Op):", "    r = r(input)"]
+            else:
+                body = ["r = %s(r)" % value(step[1]), "if isinstance(r, Op):", "    r = r(input)"]
+            lines += ["    " + line for line in body]
+            if nullable:
+                lines += ["    if r is None:", "        return None"]
+        lines.append("    return r")
+        source = "\n".join(lines)
+        exec(codecache.compile_source(source, "<op>"), env)
+        self.compiled = env["op"]
+        self.compiled.source = source
+        return self.compiled
 
     def __call__(self, input):
-        self.input = input
-        result = input
-        for f in self.funcs:
-            result = f(result)
-            if isinstance(result, Op):
-                result = result(input)
-            if result is None:
-                return None
-        return result
+        compiled = self.compiled
+        if compiled is None:
+            compiled = self.compile()
+        return compiled(input)
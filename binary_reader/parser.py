@@ -1,16 +1,98 @@
+import contextlib
+import contextvars
 import functools
 import struct
 import enum
 import collections
 import types
+import sys
+import time
 
+from . import codecache
 from .operator import Op, Size
 
 
-def checking(cond, msg):
-    # assert cond, msg
-    if not cond:
-        print(msg)
+class DecodeError(ValueError):
+    pass
+
+
+class Diagnostic(collections.namedtuple('Diagnostic', ['kind', 'name', 'offset', 'detail'])):
+    # kept unformatted, the message is only built when the record is printed
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s %s at offset %s: %s" % (self.kind, self.name, self.offset, self.detail)
+
+
+class Diagnostics:
+    # strict raises DecodeError, collect keeps up to limit records, silent drops everything
+    MODES = ("strict", "collect", "silent")
+
+    def __init__(self, mode="collect", *, limit=1000):
+        self.reset(mode, limit=limit)
+
+    def reset(self, mode="collect", *, limit=1000):
+        if mode not in Diagnostics.MODES:
+            raise ValueError("unknown diagnostics mode %r" % mode)
+        self.mode = mode
+        self.limit = limit
+        self.records = []
+        self.dropped = 0
+
+    def report(self, kind, name, offset, detail=None):
+        if self.mode == "silent":
+            return
+        record = Diagnostic(kind, name, offset, detail)
+        if self.mode == "strict":
+            raise DecodeError(record)
+        if self.limit is None or len(self.records) < self.limit:
+            if isinstance(detail, BaseException):
+                # the traceback would keep the decoder frame alive, and with it the buffer being decoded
+                record = record._replace(detail=detail.with_traceback(None))
+            self.records.append(record)
+        else:
+            self.dropped += 1
+
+    def clear(self):
+        self.records.clear()
+        self.dropped = 0
+
+
+# the process wide instance, diagnosing() swaps in another one for the current thread or asyncio task only
+diagnostics = Diagnostics()
+current_diagnostics = contextvars.ContextVar("diagnostics", default=diagnostics)
+
+
+def report(kind, name, offset, detail=None):
+    current_diagnostics.get().report(kind, name, offset, detail)
+
+
+def set_diagnostics(mode="collect", *, limit=1000):
+    # in place, so modules that imported diagnostics keep seeing the instance in use
+    diagnostics.reset(mode, limit=limit)
+    return diagnostics
+
+
+@contextlib.contextmanager
+def diagnosing(mode="collect", *, limit=1000):
+    scoped = Diagnostics(mode, limit=limit)
+    token = current_diagnostics.set(scoped)
+    try:
+        yield scoped
+    finally:
+        current_diagnostics.reset(token)
+
+
+def failed_size(func, cache):
+    # bytes a function that raised would have read, from its optional fallback_size(cache); None when unknown,
+    # then nothing after it can be located and the decoding stops there
+    fallback = getattr(func, "fallback_size", None)
+    if fallback is None:
+        return None
+    try:
+        return fallback(cache)
+    except Exception:
+        return None
 
 
 def with_tuple(t, i, v):
@@ -31,10 +113,45 @@ class Mode(enum.Enum):
     FUNCTION = 3
     DYNAMIC = 4
     LIST = 5
+    FUSED = 6
 
 class Struct(struct.Struct):
     keep_array = False
 
+
+class Profile:
+    # per field call count, time and bytes keyed by (schema, field, mode), see Schema.profile and read_schema
+    def __init__(self):
+        self.stats = {}
+
+    def recorder(self, schema):
+        stats = self.stats
+
+        def record(name, mode, seconds, size):
+            key = (schema, name, mode)
+            stat = stats.get(key)
+            if stat is None:
+                stat = stats[key] = [0, 0.0, 0]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] += size
+        return record
+
+    def clear(self):
+        self.stats.clear()
+
+    def as_dict(self):
+        result = {}
+        for (schema, name, mode), (count, seconds, size) in self.stats.items():
+            result.setdefault(schema, {}).setdefault(name, {})[mode] = {"count": count, "time": seconds, "bytes": size}
+        return result
+
+    def folded(self):
+        # collapsed stacks with microseconds as the sample value, for flamegraph.pl / speedscope
+        return "\n".join("%s;%s;%s %d" % (schema, name, mode, round(seconds * 1e6))
+                         for (schema, name, mode), (_, seconds, _) in sorted(self.stats.items()))
+
+
 class Schema:
     NA = type(None)
     def __init__(self, name=None, format=None, check=NA, *, mode=None):
@@ -43,6 +160,11 @@ class Schema:
         self.format = format
         self.check = check
         self.size = None
+        self.decoder = None
+        self.plain_decoder = None
+        self.table = None
+        self.prune = False
+        self.field_decoders = {}
         if isinstance(self.format, tuple) and self.format[0] == "tuple":
             self.__init__(*self.format[1])
             return
@@ -102,7 +224,6 @@ class Schema:
                 if v.size is None:
                     v.infer_size()
                 size += v.size
-                print(v, size)
             self.size = size
         elif self.mode == Mode.DYNAMIC:
             self.size = Size.from_(self.format)
@@ -115,6 +236,7 @@ class Schema:
             self.size += Size.from_(self.format[2])
 
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def struct(s):
         keep_array = False
         if s.startswith("["):
@@ -141,15 +263,24 @@ class Schema:
                 f = f[0]
         return f
 
+    @staticmethod
+    def function_args(f):
+        if isinstance(f, tuple) and f[0] == "function":
+            f = f[1:]
+        if isinstance(f, tuple):
+            if len(f) == 2:
+                return f
+            f = f[0]
+        return f, getattr(f, "_args", None)
+
     @classmethod
-    def compile(cls, source, *, name="_", check=NA, table=None):
+    def compile(cls, source, *, name="_", check=NA, table=None, codegen=False, prune=False):
         mode = None
         if isinstance(source, list):
             format = []
             for i in source:
                 c = cls.compile(("tuple", i), table=table)
                 c.infer_size()
-                print("compile %s -> %s" % (i, c))
                 format.append(c)
             source = format
             mode = Mode.LIST
@@ -179,8 +310,181 @@ class Schema:
         elif callable(source):
             mode = Mode.DYNAMIC
         if mode is None:
-            print("warning: unknown type %s to compile" % type(source))
-        return cls(name, source, check, mode=mode)
+            report("compile", name, None, type(source))
+        schema = cls(name, source, check, mode=mode)
+        schema.table = table
+        schema.prune = prune
+        if codegen:
+            schema.decoder = schema.build_decoder(table=table, prune=prune)
+        return schema
+
+    def profile(self, profile=None):
+        # swap in a decoder recording every field into profile, unprofile() puts the plain one back
+        if profile is None:
+            profile = Profile()
+        if self.plain_decoder is None:
+            self.plain_decoder = self.decoder
+        self.decoder = self.build_decoder(table=self.table, prune=self.prune, profile=profile)
+        return profile
+
+    def unprofile(self):
+        if self.plain_decoder is not None or self.decoder is not None:
+            self.decoder, self.plain_decoder = self.plain_decoder, None
+
+    @staticmethod
+    def field_dependencies(field, *, table=None):
+        # cache names one field reads, None when some callable does not declare what it reads
+        table = table or {}
+        mode, format = field.mode, field.format
+        if mode == Mode.DYNAMIC:
+            # the format picked at runtime may be any function of the table
+            callables = [format] + [Schema.function_args(f)[0] for f in table.values()]
+        elif mode == Mode.FUNCTION:
+            callables = [Schema.function_args(table.get(format, format) if isinstance(format, str) else format)[0]]
+        elif mode == "set":
+            callables = [format[1]]
+        elif isinstance(mode, str) and mode.startswith("read_until"):
+            callables = [format[2]]
+            if isinstance(format[1], str) and format[1] in table:
+                callables.append(Schema.function_args(table[format[1]])[0])
+            elif Schema.infer_mode(format[1], table=table) not in (Mode.STRUCT, Mode.BYTES):
+                return None
+        elif mode in (Mode.NONE, Mode.STRUCT, Mode.BYTES, Mode.FUSED):
+            callables = []
+        else:
+            return None
+        names = set()
+        for f in callables:
+            if not callable(f):
+                continue
+            if isinstance(f, Op):
+                deps = None if f.opaque else f.deps
+            else:
+                deps = getattr(f, "deps", None)
+            if deps is None:
+                return None
+            names.update(deps)
+        return names
+
+    def dependencies(self, *, table=None):
+        names = set()
+        for field in self.format:
+            deps = Schema.field_dependencies(field, table=table)
+            if deps is None:
+                return None
+            names.update(deps)
+        return names
+
+    def static_offsets(self):
+        # offset of each field for as long as every field before it has a static size, None after that
+        offsets, cur = [], 0
+        for field in self.format:
+            offsets.append(cur)
+            if cur is not None:
+                size = field.size
+                cur = None if size is None or size.size_ else cur + size.size
+        return offsets
+
+    def index_of(self, name):
+        for i, field in enumerate(self.format):
+            if field.name == name:
+                return i
+        raise KeyError(name)
+
+    def offset_of(self, name):
+        return self.static_offsets()[self.index_of(name)]
+
+    def read_field(self, bin, name, *, offset=0, cache=None):
+        decoder = self.field_decoders.get(name)
+        if decoder is None:
+            decoder = self.field_decoders[name] = self.build_field_decoder(name, table=self.table)
+        if cache is None:
+            cache = {}
+        return decoder(bin, cache, offset)
+
+    def field_plan(self, name, *, table=None):
+        # (offset, field) to decode for one field: its dependencies at their static offsets when possible,
+        # otherwise the whole prefix in order, as when a field on the way reads undeclared cache entries
+        # (an opaque Op, a function without deps) or its own position
+        index, offsets = self.index_of(name), self.static_offsets()
+        needed, pending = {index}, [index]
+        while pending:
+            deps = Schema.field_dependencies(self.format[pending.pop()], table=table)
+            if deps is None or ("cur",) in deps:
+                needed = None
+                break
+            for i, field in enumerate(self.format[:index]):
+                if field.name in deps and i not in needed:
+                    needed.add(i)
+                    pending.append(i)
+        if needed is None or any(offsets[i] is None for i in needed):
+            return [(None, field) for field in self.format[:index + 1]]
+        return [(offsets[i], self.format[i]) for i in sorted(needed)]
+
+    def build_field_decoder(self, name, *, table=None):
+        plan = self.field_plan(name, table=table)
+        live = set()
+        for _, field in plan:
+            deps = Schema.field_dependencies(field, table=table)
+            live = None if live is None or deps is None else live | deps
+        env = self.decoder_env(table, live)
+        env["stop"] = "None"
+        lines = [
+            "def decode(bin, cache, offset=0):",
+            "    out = {}",
+            "    cur = 0",
+        ]
+        for i, (at, field) in enumerate(plan):
+            if at is not None:
+                lines.append("    cur = %d" % at)
+            if i == len(plan) - 1:
+                lines.append("    v = None")
+            lines += ["    " + line for line in codegen_field(i, field, env)]
+        lines.append("    return out[N%d] if N%d in out else v" % (len(plan) - 1, len(plan) - 1))
+        return self.exec_decoder(lines, env, "<field %s.%s>" % (self.name, name))
+
+    def decoder_env(self, table, live=None):
+        return {
+            "struct": struct,
+            "report": report,
+            "read_field": read_field,
+            "read_dynamic": read_dynamic,
+            "read_schema_list_raw": read_schema_list_raw,
+            "failed_size": failed_size,
+            "FAILED": FAILED,
+            "table": table or {},
+            "live": live,
+        }
+
+    def exec_decoder(self, lines, env, filename):
+        source = "\n".join(lines)
+        exec(codecache.compile_source(source, filename), env)
+        decode = env["decode"]
+        decode.source = source
+        return decode
+
+    def build_decoder(self, *, table=None, fuse=True, prune=False, profile=None):
+        assert self.mode == Mode.LIST, "cannot build decoder for %s" % self
+        env = self.decoder_env(table, self.dependencies(table=table) if prune else None)
+        if profile is not None:
+            env["clock"], env["record"] = time.perf_counter, profile.recorder(self.name)
+        lines = [
+            "def decode(bin, cache=None, offset=0):",
+            "    if cache is None:",
+            "        cache = {}",
+            "    out = {}",
+            "    cur = 0",
+        ]
+        fields = fuse_struct(self.format) if fuse else self.format
+        for i, field in enumerate(fields):
+            body = codegen_field(i, field, env)
+            if profile is not None and body:
+                body = codegen_profile(i, field, env, body)
+            lines += ["    " + line for line in body]
+        lines.append("    return out")
+        decode = self.exec_decoder(lines, env, "<decoder %s>" % self.name)
+        decode.profile = profile
+        return decode
 
     def __repr__(self):
         if self.mode == Mode.LIST:
@@ -190,34 +494,72 @@ class Schema:
             self.name, self.mode, self.format, self.size)
 
 
+class Schemas(dict):
+    # name -> Schema, each compiled the first time it is looked up
+    def __init__(self, sources, **options):
+        super().__init__()
+        self.sources = sources
+        self.options = options
+
+    def __missing__(self, key):
+        source, name = self.sources[key]
+        schema = self[key] = Schema.compile(source, name=name, **self.options)
+        return schema
+
+    def get(self, key, default=None):
+        return self[key] if key in self.sources else default
+
+    def __contains__(self, key):
+        return key in self.sources
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def keys(self):
+        return self.sources.keys()
+
+    def values(self):
+        return [self[key] for key in self.sources]
+
+    def items(self):
+        return [(key, self[key]) for key in self.sources]
+
+
 Result = collections.namedtuple('Result', ['name', 'cur', 'size', 'value', 'schema'])
+# returned instead of a field that failed without a fallback_size: nothing after it can be located, unlike a
+# None field that is absent and takes no bytes
+FAILED = object()
 
 
-def read_schema_raw(mode, format, bin, cur, *, name="_", table=None, cache=None):
+def read_schema_raw(mode, format, bin, cur, *, offset=0, name="_", table=None, cache=None):
     size, result = 0, None
 
     if mode == Mode.LIST:
         format = [with_tuple(v, 0, ("sub", name, v[0])) if isinstance(v, tuple) else (("sub", name, i), v) for i, v in
                   enumerate(format)]
-        result = list(read_schema(format, bin[cur:], table=table, cache=cache, yield_end=True))
+        result = list(read_schema(format, bin, offset=offset + cur, table=table, cache=cache, yield_end=True))
         size = result.pop()[1]
         result = [with_tuple(v, 0, v[0][2]) if isinstance(i, tuple) or True else v[3] for i, v in zip(format, result)]
     elif mode == Mode.FUNCTION:
         if table is not None and format in table:
             format = table[format]
-        func = Schema.function(format)
-        cache[("args",)] = getattr(func, "_args", None)
+        func, cache[("args",)] = Schema.function_args(format)
         try:
-            size, result = func(bin, cur, cache)
-        except:
-            print("unpack failed %s at offset %s" % (i, cur))
-        del cache[("args",)]
+            size, result = func(bin, offset + cur, cache)
+        except Exception as e:
+            report("unpack", name, cur, e)
+            size = failed_size(func, cache)
+        finally:
+            del cache[("args",)]
     elif mode == Mode.BYTES:
         size = format
-        result = bin[cur:cur + size]
+        result = bin[offset + cur:offset + cur + size]
         if len(result) != size:
+            report("short", name, cur, (format, len(result)))
             size = len(result)
-            print("cannot read enough bytes %s at offset %s (%s)" % ((name, format), cur, size))
     elif mode == Mode.STRUCT:
         keep_array = False
         if isinstance(format, str):
@@ -227,9 +569,9 @@ def read_schema_raw(mode, format, bin, cur, *, name="_", table=None, cache=None)
         size = format.size
         result = []
         try:
-            result = format.unpack(bin[cur:cur + size])
-        except:
-            print("unpack failed %s at offset %s" % ((name, format), cur))
+            result = format.unpack_from(bin, offset + cur)
+        except struct.error as e:
+            report("unpack", name, cur, e)
         if not keep_array:
             if len(result) == 0:
                 result = None
@@ -240,7 +582,158 @@ def read_schema_raw(mode, format, bin, cur, *, name="_", table=None, cache=None)
     return size, result
 
 
-def read_schema(schema, bin, *, table=None, cache=None, yield_end=False):
+def read_field(mode, name, format, bin, cur, *, offset=0, table=None, cache=None):
+    while mode == Mode.DYNAMIC:
+        format = format(cache)
+        mode = Schema.infer_mode(format, table=table)
+
+    size, result = 0, None
+    if mode == Mode.NONE:
+        return None
+    elif isinstance(mode, str) and mode.startswith("read_until"):
+        mode = format[0]
+        sub_cur = cur
+        if mode == "read_until_size":
+            format_, to_size = format[1:]
+            if callable(to_size):
+                to_size = to_size(cache)
+            stop = lambda cache, cur_start=sub_cur: sub_cur - cur_start >= to_size
+        elif mode == "read_until_offset":
+            format_, to_offset = format[1:]
+            if callable(to_offset):
+                to_offset = to_offset(cache)
+            stop = lambda cache: sub_cur >= to_offset
+        size, result = 0, []
+        mode_ = Schema.infer_mode(format_, table=table)
+        while not stop(cache):
+            size_, result_ = read_schema_raw(mode_, format_, bin, sub_cur, offset=offset, table=table, cache=cache)
+            if size_ is None:
+                break
+            size += size_
+            result.append(result_)
+            sub_cur += size_
+    elif isinstance(mode, str) and mode == "set":
+        size, result = 0, format[1]
+        if callable(result):
+            args = None
+            if len(format) > 2:
+                args = format[2]
+            cache[("args",)] = args
+            result = result(cache)
+            del cache[("args",)]
+        if result is None:
+            return None
+    elif isinstance(mode, str):
+        assert False, "unknown mode %s" % mode
+    else:
+        size, result = read_schema_raw(mode, format, bin, cur, offset=offset, name=name, table=table, cache=cache)
+        if size is None:
+            return FAILED
+    return size, result, format
+
+
+def build_reader(format, *, name="_", table=None):
+    mode = Schema.infer_mode(format, table=table)
+    if mode == Mode.STRUCT:
+        if isinstance(format, str):
+            format = Schema.struct(format)
+        size = format.size
+        keep_array = getattr(format, "keep_array", False)
+        count = len(format.unpack(bytes(size)))
+
+        def read(bin, pos, cache, args=None):
+            try:
+                result = format.unpack_from(bin, pos)
+            except struct.error as e:
+                report("unpack", name, pos, e)
+                return size, [] if keep_array else None
+            if keep_array:
+                return size, result
+            if count == 1:
+                return size, result[0]
+            return size, list(result) if count else None
+    elif mode == Mode.BYTES:
+        size = format
+
+        def read(bin, pos, cache, args=None):
+            result = bin[pos:pos + size]
+            if len(result) != size:
+                report("short", name, pos, (size, len(result)))
+                return len(result), result
+            return size, result
+    elif mode == Mode.FUNCTION:
+        if table is not None and format in table:
+            format = table[format]
+        func, args = Schema.function_args(format)
+
+        def read(bin, pos, cache, args=args):
+            cache[("args",)] = args
+            try:
+                return func(bin, pos, cache)
+            except Exception as e:
+                report("unpack", name, pos, e)
+                return failed_size(func, cache), None
+            finally:
+                del cache[("args",)]
+    else:
+        return None
+    return read
+
+
+def cached_reader(readers, format, *, name="_", table=None):
+    # function formats that only differ by their args (a record column per serial type) share one reader
+    # taking the args at call time, so readers holds one entry per format of the schema, not per value read
+    key, args = format, ()
+    if isinstance(format, tuple) and len(format) == 3 and format[0] == "function":
+        key, args = format[:2], format[2:]
+    try:
+        reader = readers[key]
+    except KeyError:
+        reader = readers[key] = build_reader(key, name=name, table=table)
+    except TypeError:
+        reader = None
+    return reader, args
+
+
+def read_dynamic(readers, name, format, bin, cur, *, offset=0, table=None, cache=None):
+    format = format(cache)
+    if format is None:
+        return None
+    reader, args = cached_reader(readers, format, name=name, table=table)
+    if reader is None:
+        if isinstance(format, list):
+            return read_list(readers, name, format, bin, cur, offset=offset, table=table, cache=cache)
+        return read_field(Schema.infer_mode(format, table=table), name, format, bin, cur,
+                          offset=offset, table=table, cache=cache)
+    size, result = reader(bin, offset + cur, cache, *args)
+    if size is None:
+        return FAILED
+    return size, result, format
+
+
+def read_list(readers, name, format, bin, cur, *, offset=0, table=None, cache=None):
+    if not all(isinstance(v, tuple) and len(v) == 2 for v in format):
+        return read_field(Mode.LIST, name, format, bin, cur, offset=offset, table=table, cache=cache)
+    size, result = 0, []
+    for sub_name, sub_format in format:
+        reader, args = cached_reader(readers, sub_format, name=sub_name, table=table)
+        if reader is None:
+            return read_field(Mode.LIST, name, format, bin, cur, offset=offset, table=table, cache=cache)
+        size_, result_ = reader(bin, offset + cur + size, cache, *args)
+        if size_ is None:
+            return FAILED
+        cache[("sub", name, sub_name)] = (size, size_, result_)
+        result.append(Result(sub_name, size, size_, result_, (sub_format, Schema.NA)))
+        size += size_
+    cache[("cur",)] = size
+    return size, result, format
+
+
+def read_schema(schema, bin, *, offset=0, table=None, cache=None, yield_end=False, profile=None, schema_name="_"):
+    # profile is a Profile, recorded under schema_name, or one of its recorders; the checks are the only cost
+    # when it is off
+    if isinstance(profile, Profile):
+        profile = profile.recorder(schema_name)
     cur = 0
     if table is None:
         table = {}
@@ -254,54 +747,25 @@ def read_schema(schema, bin, *, table=None, cache=None, yield_end=False):
         else:
             mode, name, format, check = i.mode, i.name, i.format, i.check
 
-        while mode == Mode.DYNAMIC:
-            format = format(cache)
-            mode = Schema.infer_mode(format, table=table)
-
-        size, result = 0, None
-        if mode == Mode.NONE:
+        if profile is not None:
+            start = time.perf_counter()
+        field = read_field(mode, name, format, bin, cur, offset=offset, table=table, cache=cache)
+        if profile is not None:
+            profile(name, mode.name if isinstance(mode, Mode) else mode, time.perf_counter() - start,
+                    0 if field is None or field is FAILED else field[0])
+        if field is None:
             continue
-        elif isinstance(mode, str) and mode.startswith("read_until"):
-            mode = format[0]
-            sub_cur = cur
-            if mode == "read_until_size":
-                format_, to_size = format[1:]
-                if callable(to_size):
-                    to_size = to_size(cache)
-                stop = lambda cache, cur_start=sub_cur: sub_cur - cur_start >= to_size
-            elif mode == "read_until_offset":
-                format_, offset = format[1:]
-                if callable(offset):
-                    offset = offset(cache)
-                stop = lambda cache: sub_cur >= offset
-            size, result = 0, []
-            mode_ = Schema.infer_mode(format_, table=table)
-            while not stop(cache):
-                size_, result_ = read_schema_raw(mode_, format_, bin, sub_cur, table=table, cache=cache)
-                size += size_
-                result.append(result_)
-                sub_cur += size_
-        elif isinstance(mode, str) and mode == "set":
-            size, result = 0, format[1]
-            if callable(result):
-                args = None
-                if len(format) > 2:
-                    args = format[2]
-                cache[("args",)] = args
-                result = result(cache)
-                del cache[("args",)]
-            if result is None:
-                continue
-        elif isinstance(mode, str):
-            assert False, "unknown mode %s" % mode
-        else:
-            size, result = read_schema_raw(mode, format, bin, cur, name=name, table=table, cache=cache)
+        if field is FAILED:
+            break
+        size, result, format = field
 
         if check != Schema.NA:
             if callable(check):
-                checking(check(result), "reading %s at offset %d: %s" % (i, cur, result))
+                if not check(result):
+                    report("check", name, cur, result)
             elif check:
-                checking(result == check, "reading %s at offset %d: %s" % (i, cur, result))
+                if result != check:
+                    report("check", name, cur, result)
         if cache is not None:
             cache[name] = (cur, size, result)
             cache[("cur",)] = cur + size
@@ -312,6 +776,243 @@ def read_schema(schema, bin, *, table=None, cache=None, yield_end=False):
         yield Result("_end", cur, 0, None, None)
 
 
+def struct_order(format):
+    s = format.format
+    order, body = ("@", s) if s[:1] not in "@=<>!" else (s[0], s[1:])
+    if order == "!":
+        order = ">"
+    elif order == "=":
+        order = "<" if sys.byteorder == "little" else ">"
+    elif order == "@":
+        if body.strip("0123456789 bBcxs?p"):
+            return None, body
+        order = ""
+    return order, body
+
+
+def fuse_struct(fields):
+    fused, run, order = [], [], ""
+
+    def flush():
+        if len(run) > 1:
+            fmt = (order or "<") + "".join(body for _, body in run)
+            fused.append(Schema(tuple(f.name for f, _ in run), (Struct(fmt), [f for f, _ in run]), mode=Mode.FUSED))
+        else:
+            fused.extend(f for f, _ in run)
+        run.clear()
+
+    for field in fields:
+        field_order, body = None, None
+        if field.mode == Mode.STRUCT and not isinstance(field.format, str):
+            field_order, body = struct_order(field.format)
+        elif field.mode == Mode.BYTES:
+            field_order, body = "", "%ds" % field.format
+        if field_order is None or (field_order and order and field_order != order):
+            flush()
+            order = ""
+        if field_order is None:
+            fused.append(field)
+            continue
+        order = order or field_order
+        run.append((field, body))
+    flush()
+    return fused
+
+
+def codegen_store(i, field, env, *, at="cur", size="s", listed=False):
+    name, check = field.name, field.check
+    N, S = "N%s" % i, "S%s" % i
+    env[N], env[S] = name, field
+    tail = []
+    if check != Schema.NA:
+        env["C%s" % i] = check.compile() if isinstance(check, Op) else check
+        if callable(check):
+            tail.append("if not C%s(v):" % i)
+        elif check:
+            tail.append("if v != C%s:" % i)
+        if tail:
+            tail.append("    report(\"check\", %s, %s, v)" % (N, at))
+    if env.get("live") is None or name in env["live"]:
+        tail.append("cache[%s] = (%s, %s, v)" % (N, at, size))
+    if isinstance(name, str) and not name.startswith("_"):
+        if listed:
+            tail.append("out[%s] = list(read_schema_list_raw(v, without_name=True)) if isinstance(f, list) else v" % N)
+        else:
+            tail.append("out[%s] = v" % N)
+    return tail
+
+
+def codegen_fused(i, field, env):
+    fused, fields = field.format
+    env["F%s" % i] = fused
+    lines = [
+        "try:",
+        "    t = F%s.unpack_from(bin, offset + cur)" % i,
+        "except struct.error:",
+        "    t = None",
+        "if t is not None:",
+    ]
+    fallback = []
+    offset, index = 0, 0
+    for j, sub in enumerate(fields):
+        key = "%s_%d" % (i, j)
+        if sub.mode == Mode.BYTES:
+            size, value = sub.format, "t[%d]" % index
+            index += 1
+        else:
+            size = sub.format.size
+            count = len(sub.format.unpack(bytes(size)))
+            if getattr(sub.format, "keep_array", False):
+                value = "t[%d:%d]" % (index, index + count)
+            elif count == 0:
+                value = "None"
+            elif count == 1:
+                value = "t[%d]" % index
+            else:
+                value = "list(t[%d:%d])" % (index, index + count)
+            index += count
+        at = "cur + %d" % offset if offset else "cur"
+        store = ["v = %s" % value] + codegen_store(key, sub, env, at=at, size=str(size))
+        lines += ["    " + line for line in store]
+        fallback += ["    " + line for line in codegen_field(key, sub, env)]
+        offset += size
+    if env.get("live") is None or ("cur",) in env["live"]:
+        lines.append("    cache[(\"cur\",)] = cur + %d" % offset)
+    lines += [
+        "    cur += %d" % offset,
+        "else:",
+    ]
+    return lines + fallback
+
+
+def codegen_profile(i, field, env, body):
+    name = field.name if isinstance(field.name, str) else ",".join(field.name)
+    env["K%s" % i] = (name, field.mode.name if isinstance(field.mode, Mode) else field.mode)
+    return ["p0, c0 = clock(), cur"] + body + ["record(*K%s, clock() - p0, cur - c0)" % i]
+
+
+def codegen_field(i, field, env):
+    mode, name, format = field.mode, field.name, field.format
+    N, F, S = "N%s" % i, "F%s" % i, "S%s" % i
+    env[N], env[F], env[S] = name, format.compile() if isinstance(format, Op) else format, field
+    optional, listed = None, False
+
+    if mode == Mode.NONE:
+        return []
+    elif mode == Mode.FUSED:
+        return codegen_fused(i, field, env)
+    elif mode == Mode.STRUCT:
+        if isinstance(format, str):
+            format = env[F] = Schema.struct(format)
+        count = len(format.unpack(bytes(format.size)))
+        if getattr(format, "keep_array", False):
+            read, failed = "v = %s.unpack_from(bin, offset + cur)" % F, "[]"
+        elif count == 0:
+            read, failed = "v = None", "None"
+        elif count == 1:
+            read, failed = "v, = %s.unpack_from(bin, offset + cur)" % F, "None"
+        else:
+            read, failed = "v = list(%s.unpack_from(bin, offset + cur))" % F, "None"
+        body = [
+            "s = %d" % format.size,
+            "try:",
+            "    " + read,
+            "except struct.error as e:",
+            "    report(\"unpack\", %s, cur, e)" % N,
+            "    v = %s" % failed,
+        ]
+    elif mode == Mode.BYTES:
+        body = [
+            "s = %d" % format,
+            "v = bin[offset + cur:offset + cur + %d]" % format,
+            "if len(v) != %d:" % format,
+            "    report(\"short\", %s, cur, (%d, len(v)))" % (N, format),
+            "    s = len(v)",
+        ]
+    elif mode == Mode.FUNCTION:
+        if format in env["table"]:
+            format = env["table"][format]
+        env[F], env["A%s" % i] = Schema.function_args(format)
+        body = [
+            "cache[(\"args\",)] = A%s" % i,
+            "try:",
+            "    s, v = %s(bin, offset + cur, cache)" % F,
+            "except Exception as e:",
+            "    report(\"unpack\", %s, cur, e)" % N,
+            "    s, v = failed_size(%s, cache), None" % F,
+            "    if s is None:",
+            "        del cache[(\"args\",)]",
+            "        return %s" % env.get("stop", "out"),
+            "del cache[(\"args\",)]",
+        ]
+    elif mode == "set":
+        env[F] = format[1].compile() if isinstance(format[1], Op) else format[1]
+        if callable(format[1]):
+            env["A%s" % i] = format[2] if len(format) > 2 else None
+            body = [
+                "cache[(\"args\",)] = A%s" % i,
+                "v = %s(cache)" % F,
+                "del cache[(\"args\",)]",
+            ]
+        else:
+            body = ["v = %s" % F]
+        body.append("s = 0")
+        if format[1] is None or callable(format[1]):
+            optional = "v is not None"
+    elif mode == "read_until_offset" and Schema.infer_mode(format[1], table=env["table"]) == Mode.FUNCTION:
+        func = format[1]
+        if func in env["table"]:
+            func = env["table"][func]
+        env[F], env["A%s" % i] = Schema.function_args(func)
+        env["O%s" % i] = format[2].compile() if isinstance(format[2], Op) else format[2]
+        body = [
+            "o = O%s(cache)" % i if callable(format[2]) else "o = O%s" % i,
+            "e = cur",
+            "v = []",
+            "while e < o:",
+            "    cache[(\"args\",)] = A%s" % i,
+            "    try:",
+            "        s, x = %s(bin, offset + e, cache)" % F,
+            "    except Exception as err:",
+            "        report(\"unpack\", %s, e, err)" % N,
+            "        s, x = failed_size(%s, cache), None" % F,
+            "        if s is None:",
+            "            del cache[(\"args\",)]",
+            "            break",
+            "    del cache[(\"args\",)]",
+            "    v.append(x)",
+            "    e += s",
+            "s = e - cur",
+        ]
+    elif mode == Mode.DYNAMIC:
+        env["R%s" % i] = {}
+        body = [
+            "r = read_dynamic(R%s, %s, %s, bin, cur, offset=offset, table=table, cache=cache)" % (i, N, F),
+            "if r is FAILED:",
+            "    return %s" % env.get("stop", "out"),
+        ]
+        optional, listed = "r is not None", True
+    else:
+        env["M%s" % i] = mode
+        body = [
+            "r = read_field(M%s, %s, %s, bin, cur, offset=offset, table=table, cache=cache)" % (i, N, F),
+            "if r is FAILED:",
+            "    return %s" % env.get("stop", "out"),
+        ]
+        optional, listed = "r is not None", True
+
+    tail = codegen_store(i, field, env, listed=listed)
+    if env.get("live") is None or ("cur",) in env["live"]:
+        tail.append("cache[(\"cur\",)] = cur + s")
+    tail.append("cur += s")
+
+    if optional is None:
+        return body + tail
+    if listed:
+        tail.insert(0, "s, v, f = r")
+    return body + ["if %s:" % optional] + ["    " + line for line in tail]
+
+
 def read_schema_list_raw(results, *, without_name=False, filter_starts=None):
     for result in results:
         if filter_starts is not None and result.name.startswith(filter_starts):
@@ -334,7 +1035,8 @@ def read_schema_list_raw(results, *, without_name=False, filter_starts=None):
             yield (result.name, value)
 
 
-def read_schema_list(schema, bin_, *, table=None, cache=None):
+def read_schema_list(schema, bin_, *, offset=0, table=None, cache=None, profile=None, schema_name="_"):
     if cache is None:
         cache = {}
-    return read_schema_list_raw(read_schema(schema, bin_, table=table, cache=cache), filter_starts="_")
+    return read_schema_list_raw(read_schema(schema, bin_, offset=offset, table=table, cache=cache, profile=profile,
+                                            schema_name=schema_name), filter_starts="_")
@@ -0,0 +1,186 @@
+import collections
+
+from .sqlite3_schema import read_value
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# https://www.sqlite.org/fileformat2.html#record_format
+SERIAL_TYPE_SIZES = [0, 1, 2, 3, 4, 6, 8, 8, 0, 0, 0, 0]
+
+LeafLayout = collections.namedtuple('LeafLayout', ['cell_offsets', 'payload_size', 'rowid', 'payload_start',
+                                                   'serial_types', 'column_offsets', 'column_number', 'regular'])
+
+
+def read_varints(buf, pos):
+    # decode the varint starting at every position of pos at once, see sqlite3_schema.read_varint
+    n = len(pos)
+    index = pos[:, None] + np.arange(9)
+    np.clip(index, 0, len(buf) - 1, out=index)
+    raw = buf[index].astype(np.uint64)
+    values = np.zeros(n, dtype=np.uint64)
+    sizes = np.full(n, 9, dtype=np.int64)
+    active = np.ones(n, dtype=bool)
+    for k in range(8):
+        b = raw[:, k]
+        values = np.where(active, (values << np.uint64(7)) | (b & np.uint64(0x7f)), values)
+        ended = active & (b < 128)
+        sizes[ended] = k + 1
+        active &= ~ended
+        if not active.any():
+            return values.view(np.int64), sizes
+    values = np.where(active, (values << np.uint64(8)) | raw[:, 8], values)
+    return values.view(np.int64), sizes
+
+
+def serial_type_sizes(serial_types):
+    sizes = np.where(serial_types >= 12, (serial_types - 12) // 2, 0)
+    small = (serial_types >= 0) & (serial_types < 12)
+    sizes[small] = np.array(SERIAL_TYPE_SIZES)[serial_types[small]]
+    return sizes
+
+
+def decode_leaf_page(page_bin, header_offset, page_size):
+    # table leaf page (type 13) only; rows that overflow or look malformed are marked irregular
+    buf = np.frombuffer(page_bin, dtype=np.uint8)
+    cell_number = int.from_bytes(page_bin[header_offset + 3:header_offset + 5], "big")
+    cells = np.frombuffer(page_bin, dtype=">u2", count=cell_number, offset=header_offset + 8).astype(np.int64)
+    payload_size, size = read_varints(buf, cells)
+    rowid, size_ = read_varints(buf, cells + size)
+    payload_start = cells + size + size_
+
+    regular = (payload_size >= 0) & (payload_size <= page_size - 35)
+    regular &= payload_start + payload_size <= len(buf)
+    header_size, size = read_varints(buf, payload_start)
+    regular &= (header_size >= size) & (header_size <= payload_size)
+    header_end = payload_start + header_size
+    pos = payload_start + size
+
+    columns = []
+    active = regular & (pos < header_end)
+    while active.any():
+        serial_type, size = read_varints(buf, pos)
+        regular &= ~(active & (serial_type < 0))
+        columns.append(np.where(active, serial_type, -1))
+        pos = np.where(active, pos + size, pos)
+        active &= pos < header_end
+    regular &= pos == header_end
+
+    if columns:
+        serial_types = np.stack(columns, axis=1)
+    else:
+        serial_types = np.zeros((cell_number, 0), dtype=np.int64)
+    sizes = serial_type_sizes(serial_types)
+    ends = header_end[:, None] + np.cumsum(sizes, axis=1)
+    column_offsets = ends - sizes
+    if columns:
+        regular &= ends[:, -1] <= payload_start + payload_size
+    column_number = (serial_types >= 0).sum(axis=1)
+    return LeafLayout(cells, payload_size, rowid, payload_start, serial_types, column_offsets, column_number, regular)
+
+
+ColumnarBatch = collections.namedtuple('ColumnarBatch', ['rowid', 'columns', 'nulls'])
+
+NULL, INTEGER, REAL, OBJECT = 0, 1, 2, 3
+
+
+def read_ints(buf, offsets, size):
+    # big-endian two's complement integers of 1, 2, 3, 4, 6 or 8 bytes, sign extended to a native width
+    width = {1: 1, 2: 2, 3: 4, 4: 4, 6: 8, 8: 8}[size]
+    raw = np.empty((len(offsets), width), dtype=np.uint8)
+    raw[:, width - size:] = buf[offsets[:, None] + np.arange(size)]
+    raw[:, :width - size] = np.where(raw[:, width - size:width - size + 1] >= 128, 255, 0)
+    return raw.view(">i%d" % width).ravel()
+
+
+def read_floats(buf, offsets):
+    return np.ascontiguousarray(buf[offsets[:, None] + np.arange(8)]).view(">f8").ravel()
+
+
+class ColumnBatch:
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.size = size
+        self.count = 0
+        self.rowid = np.empty(size, dtype=np.int64)
+        self.kinds = np.zeros((len(columns), size), dtype=np.uint8)
+        self.ints = np.zeros((len(columns), size), dtype=np.int64)
+        self.floats = np.zeros((len(columns), size), dtype=np.float64)
+        self.objects = {}
+
+    @property
+    def free(self):
+        return self.size - self.count
+
+    def add_layout(self, page_bin, layout, start, stop):
+        # rows start:stop of a decoded leaf page, irregular rows are left as NULL for set_row
+        buf = np.frombuffer(page_bin, dtype=np.uint8)
+        at = self.count
+        self.rowid[at:at + stop - start] = layout.rowid[start:stop]
+        rows = np.nonzero(layout.regular[start:stop])[0] + start
+        dest = rows - start + at
+        for j, c in enumerate(self.columns):
+            if c >= layout.serial_types.shape[1]:
+                continue
+            types, offsets = layout.serial_types[rows, c], layout.column_offsets[rows, c]
+            kinds, ints, floats = self.kinds[j], self.ints[j], self.floats[j]
+            for serial_type, size in ((1, 1), (2, 2), (3, 3), (4, 4), (5, 6), (6, 8)):
+                selected = types == serial_type
+                if selected.any():
+                    ints[dest[selected]] = read_ints(buf, offsets[selected], size)
+                    kinds[dest[selected]] = INTEGER
+            for serial_type in (8, 9):
+                selected = types == serial_type
+                ints[dest[selected]] = serial_type - 8
+                kinds[dest[selected]] = INTEGER
+            selected = types == 7
+            if selected.any():
+                floats[dest[selected]] = read_floats(buf, offsets[selected])
+                kinds[dest[selected]] = REAL
+            selected = np.nonzero(types >= 12)[0]
+            if len(selected):
+                objects = self.column_objects(j)
+                for k, serial_type, offset in zip(dest[selected].tolist(), types[selected].tolist(),
+                                                  offsets[selected].tolist()):
+                    objects[k] = read_value(page_bin, offset, serial_type)[1]
+                kinds[dest[selected]] = OBJECT
+        self.count += stop - start
+
+    def set_row(self, at, rowid, values):
+        self.rowid[at] = rowid
+        for j, value in enumerate(values):
+            if value is None:
+                self.kinds[j, at] = NULL
+            elif isinstance(value, int):
+                self.ints[j, at], self.kinds[j, at] = value, INTEGER
+            elif isinstance(value, float):
+                self.floats[j, at], self.kinds[j, at] = value, REAL
+            else:
+                self.column_objects(j)[at], self.kinds[j, at] = value, OBJECT
+
+    def column_objects(self, j):
+        if j not in self.objects:
+            self.objects[j] = np.empty(self.size, dtype=object)
+        return self.objects[j]
+
+    def finish(self):
+        count = self.count
+        columns, nulls = [], []
+        for j in range(len(self.columns)):
+            kinds = self.kinds[j, :count]
+            integer, real = kinds == INTEGER, kinds == REAL
+            if (kinds == OBJECT).any():
+                values = self.objects[j][:count]
+                values[integer] = self.ints[j, :count][integer].tolist()
+                values[real] = self.floats[j, :count][real].tolist()
+            elif real.any():
+                values = self.floats[j, :count]
+                values[integer] = self.ints[j, :count][integer]
+                values[kinds == NULL] = np.nan
+            else:
+                values = self.ints[j, :count]
+            columns.append(values)
+            nulls.append(kinds == NULL)
+        return ColumnarBatch(self.rowid[:count], columns, nulls)
@@ -67,7 +67,7 @@ def local_payload_size(page_type, payload_size, page_size):
 cell_header_schema = [
     ("left_child_page", sf().cache("page_type",True).in_([2,5]).if_("!L")),
     ("payload_size", sf().cache("page_type",True).in_([2,10,13]).if_("varint")),
-    ("local_payload_size", ("set", sf().caches("page_type", ("payload_size", 2), ("config", "page_size")).apply(local_payload_size))),
+    ("local_payload_size", ("set", sf().caches("page_type", ("payload_size", 2), ("config", "page_size")).apply(local_payload_size, []))),
     ("rowid", sf().cache("page_type",True).in_([5,13]).if_("varint")),
     ("payload", sf().cache_or("local_payload_size")),
     ("overflow_page", sf().cache("page_type",True).in_([2, 10, 13]).if_(sf().cache("payload_size").eq(sf().cache("local_payload_size"))).if_(None, "!l")), # omitted if not used
@@ -82,7 +82,7 @@ block_header_schema = [
 record_format_schema = [
     ("header_size", "varint"),
     ("column_types", ("read_until_offset", "varint", sf().cache("header_size"))),
-    ("column_contents", lambda cache: [(i, ("function", read_variable, v)) for i, v in enumerate(cache["column_types"][2])]),
+    ("column_contents", sf().cache("column_types").apply_(lambda types: [(i, ("function", read_variable, v)) for i, v in enumerate(types)], [])),
 ]
 
 page_overflow_header_schema = [
@@ -104,15 +104,23 @@ def read_varint(bin, cur, _):
 
 
 def read_fixint(bin, cur, size):
-    x, = struct.unpack("b", bin[cur:cur + 1])
-    for i in range(1, size):
-        x = x * 256 + bin[cur + i]
-    return x
+    value = bin[cur:cur + size]
+    if len(value) != size:
+        report("short", "value", cur, (size, len(value)))
+        return None
+    return int.from_bytes(value, "big", signed=True)
 
 
 def read_variable(bin, cur, cache):
-    serial_type = cache[("args",)]
-    assert (serial_type >= 0)
+    return read_value(bin, cur, cache[("args",)])
+
+
+def read_value(bin, cur, serial_type):
+    # never raises: a value that cannot be read is reported and comes back as None, taking the size its
+    # serial type gives it so that the next columns stay in place
+    if serial_type < 0 or 10 <= serial_type <= 11:
+        report("serial_type", "value", cur, serial_type)
+        return 0, None
     if serial_type == 0:
         size, value = 0, None
     elif serial_type <= 6:
@@ -125,10 +133,13 @@ def read_variable(bin, cur, cache):
         value = read_fixint(bin, cur, size)
     elif serial_type == 7:
         size = 8
-        value, = struct.unpack("!d", bin[cur:cur + size])
+        if len(bin) - cur < size:
+            report("short", "value", cur, (size, max(len(bin) - cur, 0)))
+            return size, None
+        value, = struct.unpack_from("!d", bin, cur)
     elif serial_type <= 9:
         size, value = 0, serial_type % 2
-    elif serial_type >= 12:
+    else:
         if serial_type % 2 == 0:
             size = (serial_type - 12) // 2
         else:
@@ -136,23 +147,73 @@ def read_variable(bin, cur, cache):
         # print("read_variable %s %s at %s" % (serial_type, size, cur))
         value = bin[cur:cur + size]
         if len(value) != size:
-            print("cannot read enough bytes at offset %s (%s, %s)" % (cur, size, len(value)))
+            report("short", "value", cur, (size, len(value)))
             size = len(value)
         if serial_type % 2 == 1:
-            value = value.decode()
+            try:
+                value = str(value, "utf-8")
+            except UnicodeDecodeError as e:
+                # sqlite3 stores whatever bytes it was given as TEXT, report them and keep the rest readable
+                report("text", "value", cur, e.reason)
+                value = str(value, "utf-8", "replace")
     return size, value
 
 
+def serial_type_size(serial_type):
+    if serial_type <= 4:
+        return serial_type
+    elif serial_type == 5:
+        return 6
+    elif serial_type <= 7:
+        return 8
+    elif serial_type <= 11:
+        return 0
+    return (serial_type - 12) // 2
+
+
+def read_record_header(bin, offset=0):
+    # (offset, serial_type) of every column of the record
+    size, header_size = read_varint(bin, offset, None)
+    cur, end = offset + size, offset + header_size
+    positions, body = [], end
+    while cur < end:
+        size, serial_type = read_varint(bin, cur, None)
+        cur += size
+        positions.append((body, serial_type))
+        body += serial_type_size(serial_type)
+    return positions
+
+
+def read_record(bin, columns=None, offset=0):
+    # decode only the selected columns of a record, using the serial types to find their offsets
+    positions = read_record_header(bin, offset)
+    if columns is None:
+        columns = range(len(positions))
+    values = []
+    for i in columns:
+        if i < len(positions):
+            values.append(read_value(bin, *positions[i])[1])
+        else:
+            values.append(None)
+    return values
+
+
+# a value that fails to decode still takes the size given by its serial type, the next columns stay in place
+read_variable.fallback_size = lambda cache: serial_type_size(cache[("args",)])
+
+# neither reads the cache besides its ("args",), so Schema.dependencies can prune the cache writes around them
+read_varint.deps = read_variable.deps = ()
+
 format_table = {
     "varint": read_varint,
     "variable": read_variable,
 }
 
-schemas = {
-    "header_schema": Schema.compile(header_schema, name="header", table=format_table),
-    "page_header_schema": Schema.compile(page_header_schema, name="page_header", table=format_table),
-    "cell_header_schema": Schema.compile(cell_header_schema, name="cell_header", table=format_table),
-    "block_header_schema": Schema.compile(block_header_schema, name="block_header", table=format_table),
-    "record_format_schema": Schema.compile(record_format_schema, name="record_format", table=format_table),
-    "page_overflow_header_schema": Schema.compile(page_overflow_header_schema, name="page_overflow_header", table=format_table),
-}
+schemas = Schemas({
+    "header_schema": (header_schema, "header"),
+    "page_header_schema": (page_header_schema, "page_header"),
+    "cell_header_schema": (cell_header_schema, "cell_header"),
+    "block_header_schema": (block_header_schema, "block_header"),
+    "record_format_schema": (record_format_schema, "record_format"),
+    "page_overflow_header_schema": (page_overflow_header_schema, "page_overflow_header"),
+}, table=format_table, codegen=True, prune=True)